@@ -1,39 +1,60 @@
 # Python standard libraries
-import json
 import os
 
 # Third party libraries
 from flask import Flask
-from mongoengine import connect
+from mongoengine import connect, disconnect
+from pymongo import monitoring
 from flask_login import LoginManager
-#from oauthlib.oauth2 import WebApplicationClient
 import certifi
 from app.utils.secrets import getSecrets
 from flask_moment import Moment
-import base64
 
-# Flask app setup
+# Flask app setup. The routes are added to this app by create_app() below, so importing
+# 'app' by itself is quick and doesn't touch the database.
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY") or os.urandom(24)
 
-# Configuration
+# Configuration. This is the only place the secrets file is read; everything else uses
+# 'from app import secrets'.
 secrets = getSecrets()
 
 # User session management setup
 # https://flask-login.readthedocs.io/en/latest
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Naive database setup
-connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
-moment = Moment(app)
+moment = Moment()
 
-def base64encode(img):
-    image = base64.b64encode(img)
-    image = image.decode('utf-8')
-    return image
 
-app.jinja_env.globals.update(base64encode=base64encode)
+def connectDB():
+    # connect=False means nothing actually connects to MongoDB until the first query. That
+    # keeps startup fast and means a gunicorn worker forked from a preloaded app opens its
+    # own connections instead of sharing the parent's. Calling this again (for example
+    # after a fork) throws away the old connection and sets up a new one.
+    disconnect()
+    connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where(), connect=False)
 
-from .routes import *
+
+_created = False
+
+
+def create_app():
+    # Sets up the app the first time it is called and just returns it after that.
+    global _created
+    if not _created:
+        _created = True
+        login_manager.init_app(app)
+        moment.init_app(app)
+        # Counts the queries each request makes, see app/utils/querylog.py. Listeners have
+        # to be registered before the MongoDB client is made.
+        from app.utils.querylog import queryListener
+        monitoring.register(queryListener)
+        # Request timings for /metrics, see app/utils/metrics.py
+        from app.utils import metrics
+        connectDB()
+
+        from app import routes, commands
+        from app.utils.images import imageUrl
+        app.jinja_env.globals.update(imageUrl=imageUrl)
+    return app
@@ -3,27 +3,20 @@
 # the name of the data collection and each item is a data 'field' that stores a piece of data.  Data 
 # fields have types like IntField, StringField etc.  This uses the Mongoengine Python Library. When 
 # you interact with the data you are creating an onject that is an instance of the class.
-import random
-from sys import getprofile
-from tokenize import String
-from typing import KeysView
-from xmlrpc.client import Boolean
-from dataclasses import dataclass
-from setuptools import SetuptoolsDeprecationWarning
-from app import app
-from flask import flash, redirect
-from flask_login import UserMixin, current_user
-from mongoengine import Document, ListField, FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, CASCADE
+from flask_login import UserMixin
+from mongoengine import queryset_manager, Document, ListField, DictField, FileField, EmailField, StringField, IntField, ObjectIdField, ReferenceField, DateTimeField, BooleanField, FloatField, PointField, CASCADE
 import datetime as dt
-import jwt
-from time import time
-from bson.objectid import ObjectId
-from flask_security import RoleMixin
-from functools import wraps
+
+
+# Users, blogs, reviews and leagues are deleted in two steps (see app/utils/cascade.py).
+# First they are marked deleted=True, which this hides from every query made through
+# .objects, then a background job removes everything under them and the document itself.
+def hideDeleted(doc_cls, queryset):
+    return queryset.filter(deleted__ne=True)
 
 
 class User(UserMixin, Document):
-    createdate = DateTimeField(defaultdefault=dt.datetime.utcnow)
+    createdate = DateTimeField(default=dt.datetime.utcnow)
     gid = StringField(sparse=True, unique=True)
     gname = StringField()
     gprofile_pic = StringField()
@@ -32,10 +25,21 @@ class User(UserMixin, Document):
     lname = StringField()
     email = EmailField()
     image = FileField()
+    # ids of the resized copies of image, see app/utils/images.py
+    image_variants = DictField()
     prononuns = StringField()
     role = StringField()
+    deleted = BooleanField()
+    objects = queryset_manager(hideDeleted)
     meta = {
-        'ordering': ['lname','fname']
+        'ordering': ['lname','fname'],
+        # the login callback finds or creates users by email in one step, unique so two
+        # logins at the same time can't create the same user twice
+        'indexes': [{'fields': ['email'], 'unique': True, 'sparse': True}],
+        # Building a unique index fails if two users already share an email, and mongoengine
+        # would try on the first query of a request. 'flask indexes' builds it (and the gid
+        # one) instead, after checking for duplicates, and the site won't start without them.
+        'auto_create_index': False
     }
 
 class Blog(Document):
@@ -46,15 +50,24 @@ class Blog(Document):
     num = IntField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+    deleted = BooleanField()
+    objects = queryset_manager(hideDeleted)
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # the list page is sorted newest first by (create_date, _id), see paginate.py
+        # author is used when a User is deleted and their documents are removed
+        # /search looks through subject, tag and content, with a match in the subject counting most
+        'indexes': [('-create_date', '-id'), 'author',
+                    {'fields': ['$subject', '$tag', '$content'], 'weights': {'subject': 10, 'tag': 5, 'content': 1}}]
     }
     
 class Listing(Document):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
     gym_location = StringField()
     gym_picture = FileField()
+    # ids of the resized copies of gym_picture, see app/utils/images.py
+    gym_picture_variants = DictField()
     gym_quality = StringField()
     price = StringField()
     gym_contact = EmailField()
@@ -62,7 +75,12 @@ class Listing(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # the list page is sorted newest first by (create_date, _id), see paginate.py
+        # author is used when a User is deleted and their documents are removed
+        # /search looks through gym_location
+        'indexes': [('-create_date', '-id'), 'author',
+                    {'fields': ['$gym_location']}]
     }
 
 class Comment(Document):
@@ -77,7 +95,9 @@ class Comment(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # a blog page loads all of the comments for that blog
+        'indexes': [('blog', '-create_date'), 'author']
     }
 
 class Clinic(Document):
@@ -92,9 +112,56 @@ class Clinic(Document):
     description = StringField()
     lat = FloatField()
     lon = FloatField()
+    # the same lat/lon as a GeoJSON point [lon, lat] so the map can search by area
+    location = PointField()
     
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-createdate'],
+        # the list page is sorted newest first by (createdate, _id), see paginate.py
+        # the map loads the clinics inside the area being looked at with a 2dsphere index
+        'indexes': [('-createdate', '-id'), 'author', '(location']
+    }
+
+class GeocodeCache(Document):
+    # Saved answers from the geocoder so the same address is only looked up once.
+    # key is the address after normalizeAddress() in app/utils/geocode.py. lat and lon
+    # are empty if the geocoder couldn't find the address. MongoDB removes entries 30 days
+    # after they were saved so addresses that change get looked up again.
+    key = StringField(required=True, unique=True)
+    lat = FloatField()
+    lon = FloatField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            {'fields': ['create_date'], 'expireAfterSeconds': 60 * 60 * 24 * 30}
+        ]
+    }
+
+class CacheVersion(Document):
+    # A counter for each collection that goes up every time something in it changes.
+    # Cached pages are kept under the versions they were made with, see
+    # app/utils/responsecache.py
+    name = StringField(primary_key=True)
+    version = IntField(default=0)
+
+class DeleteJob(Document):
+    # A document marked deleted that still has things under it to remove, see
+    # app/utils/cascade.py. counts is how many of each collection have been removed so far.
+    model = StringField(required=True)
+    root = ObjectIdField(required=True)
+    status = StringField(default='queued')
+    counts = DictField()
+    # The job belongs to whoever is running it until lease_until. If that process dies the
+    # lease runs out and another one picks the job up where it stopped.
+    owner = StringField()
+    lease_until = DateTimeField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    modify_date = DateTimeField()
+
+    meta = {
+        # finding unfinished jobs
+        'indexes': [('status', 'lease_until')]
     }
 
 class Review(Document):
@@ -106,9 +173,33 @@ class Review(Document):
     subject = StringField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+    deleted = BooleanField()
+    objects = queryset_manager(hideDeleted)
+
+    meta = {
+        'ordering': ['-create_date'],
+        # the list page is sorted newest first by (create_date, _id), see paginate.py
+        # author is used when a User is deleted and their documents are removed
+        # /search looks through the hospital name, subject and text, with a match in the name counting most
+        'indexes': [('-create_date', '-id'), 'author',
+                    {'fields': ['$name', '$subject', '$text'], 'weights': {'name': 10, 'subject': 5, 'text': 1}}]
+    }
+
+class HospitalStats(Document):
+    # Running totals of review ratings for each hospital, kept up to date by the review
+    # routes so the summary page never has to read every Review. There is one row per
+    # hospital and subject, plus one row per hospital with subject '*' for all subjects.
+    # hist counts how many reviews gave each rating: {'0': 2, '7': 5, ...}
+    # See app/utils/hospitalstats.py
+    hospital = StringField(required=True)
+    subject = StringField(required=True)
+    count = IntField(default=0)
+    sum = IntField(default=0)
+    mean = FloatField()
+    hist = DictField()
 
     meta = {
-        'ordering': ['-createdate']
+        'indexes': [{'fields': ['hospital', 'subject'], 'unique': True}]
     }
 
 class Reply(Document):
@@ -118,6 +209,10 @@ class Reply(Document):
     name = StringField()
     # This could be used to allow comments on comments
     outer = BooleanField()
+    # ids of every reply above this one, top-level reply first and direct parent last.
+    # See app/utils/replies.py
+    ancestors = ListField(ObjectIdField())
+    # the older way replies were linked. 'flask migrate-replies' fills in ancestors from it.
     replies = ListField()
     dFromOuter = IntField()
     #ReferenceField('Reply',reverse_delete_rule=CASCADE)
@@ -127,7 +222,10 @@ class Reply(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # the review page loads the whole thread for a review in one query
+        # ancestors is used to delete a reply together with all of the replies under it
+        'indexes': [('review', 'create_date', 'id'), 'ancestors', 'author']
     }
 
 class League(Document):
@@ -136,12 +234,21 @@ class League(Document):
     sport = StringField()
     founder = StringField()
     num_of_teams = IntField()
+    # How many teams are in the league. Only change it through teamslots.py
+    team_count = IntField()
     address = StringField ()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+    deleted = BooleanField()
+    objects = queryset_manager(hideDeleted)
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # the list page is sorted newest first by (create_date, _id), see paginate.py
+        # author is used when a User is deleted and their documents are removed
+        # /search looks through name, sport and address, with a match in the name counting most
+        'indexes': [('-create_date', '-id'), 'author',
+                    {'fields': ['$name', '$sport', '$address'], 'weights': {'name': 10, 'sport': 5, 'address': 2}}]
     }
 
 class Team(Document):
@@ -152,3 +259,8 @@ class Team(Document):
     author = ReferenceField('User', reverse_delete_rule=CASCADE)
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+
+    meta = {
+        # a league page loads all of the teams in that league
+        'indexes': ['league', 'author']
+    }
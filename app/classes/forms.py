@@ -3,14 +3,17 @@
 # Flask-WTForms library.
 
 from flask_wtf import FlaskForm
-import mongoengine.errors
+from flask_wtf.file import FileAllowed
 from wtforms.validators import URL, Email, DataRequired, NumberRange
-from wtforms.validators import URL, Email, DataRequired
 from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, BooleanField, URLField, EmailField
 
+
+# saveImage() in app/utils/images.py also checks that the file really is one of these.
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
 class ListingForm(FlaskForm):
     gym_location = StringField('location', validators=[DataRequired()])
-    gym_picture = FileField("Image")
+    gym_picture = FileField("Image", validators=[FileAllowed(IMAGE_EXTENSIONS, "Upload a JPEG, PNG, GIF or WebP image.")])
     gym_quality = StringField("Rating")
     gym_price = StringField("Price")
     gym_contact = EmailField('email')
@@ -19,7 +22,7 @@ class ListingForm(FlaskForm):
 class ProfileForm(FlaskForm):
     fname = StringField('First Name', validators=[DataRequired()])
     lname = StringField('Last Name', validators=[DataRequired()]) 
-    image = FileField("Image") 
+    image = FileField("Image", validators=[FileAllowed(IMAGE_EXTENSIONS, "Upload a JPEG, PNG, GIF or WebP image.")]) 
     submit = SubmitField('Post')
     role = SelectField('Role', choices=[("Owner","Owner"),("Manager","Manager")])
     location = SelectField('location', choices=[("Oakland","Oakland"),("San Francisco","San Francisco")])
@@ -69,4 +72,8 @@ class TeamForm(FlaskForm):
     name = StringField('Team Name', validators=[DataRequired()])
     coach = StringField('Coach')
     city = StringField('City')
-    submit = SubmitField('Add Team')
\ No newline at end of file
+    submit = SubmitField('Add Team')
+
+# No fields, just the CSRF token, so another site can't delete an account with a link.
+class DeleteAccountForm(FlaskForm):
+    submit = SubmitField('Delete Account')
\ No newline at end of file
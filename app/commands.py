@@ -0,0 +1,396 @@
+# Command line tools for looking after the database. Flask adds these to the 'flask'
+# command, for example:
+#     flask --app main indexes
+# Run 'flask --app main --help' to see all of them.
+import os
+import sys
+import json
+import time
+import subprocess
+import datetime as dt
+import click
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from mongoengine.queryset.visitor import Q
+from app import app, secrets
+from app.classes.data import User, Blog, Comment, Clinic, GeocodeCache, DeleteJob, Review, HospitalStats, Reply, League, Team, Listing
+from app.utils.geocode import geocodeClinic, GeocodeError
+from app.utils.hospitalstats import rebuildPipeline
+from app.utils.teamslots import teamCountPipeline
+from app.utils.cascade import markDeleted, runJob
+
+# Every collection that declares indexes in data.py
+MODELS = [User, Blog, Listing, Comment, Clinic, GeocodeCache, DeleteJob, Review, HospitalStats, Reply, League, Team]
+
+
+def hotQueries():
+    # The queries the routes run the most. Each one is explained by the indexes command so
+    # you can see if it uses an index (IXSCAN) or reads the whole collection (COLLSCAN).
+    anyId = ObjectId()
+    return [
+        ('blogList', Blog.objects().order_by('-create_date', '-id').limit(25)),
+        ('reviewList', Review.objects().order_by('-create_date', '-id').limit(25)),
+        ('leagueList', League.objects().order_by('-create_date', '-id').limit(25)),
+        ('listingList', Listing.objects().order_by('-create_date', '-id').limit(25)),
+        ('clinicList', Clinic.objects().order_by('-createdate', '-id').limit(25)),
+        ('clinic map', Clinic.objects(location__geo_within_polygon=[[[-122.3, 37.7], [-122.2, 37.7], [-122.2, 37.8], [-122.3, 37.8], [-122.3, 37.7]]])),
+        ('blog comments', Comment.objects(blog=anyId)),
+        ('league teams', Team.objects(league=anyId)),
+        ('login callback', User.objects(email='nobody@example.com')),
+        ('search blogs', Blog.objects.search_text('soccer').order_by('$text_score').limit(10)),
+        ('review replies', Reply.objects(review=anyId).order_by('+create_date', '+id')),
+    ]
+
+
+def planStages(plan):
+    # Walk down the winning plan and collect the stage names, e.g. LIMIT > FETCH > IXSCAN
+    stages = []
+    indexes = []
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        if 'indexName' in plan:
+            indexes.append(plan['indexName'])
+        if 'inputStage' in plan:
+            plan = plan['inputStage']
+        elif plan.get('inputStages'):
+            plan = plan['inputStages'][0]
+        else:
+            plan = None
+    return stages, indexes
+
+
+def explainSummary(queryset):
+    explain = queryset.explain()
+    planner = explain.get('queryPlanner', {})
+    stats = explain.get('executionStats', {})
+    stages, indexes = planStages(planner.get('winningPlan', {}))
+    return {
+        'plan': ' > '.join(stages),
+        'index': ', '.join(indexes) or '-',
+        'returned': stats.get('nReturned', '?'),
+        'keys': stats.get('totalKeysExamined', '?'),
+        'docs': stats.get('totalDocsExamined', '?'),
+        'ms': stats.get('executionTimeMillis', '?'),
+    }
+
+
+def duplicateEmails():
+    # Emails more than one user has. The unique email index can't be built while there are any.
+    pipeline = [
+        {'$match': {'email': {'$ne': None}}},
+        {'$group': {'_id': '$email', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    return [(row['_id'], row['count']) for row in rawCollection(User).aggregate(pipeline)]
+
+
+def rawCollection(model):
+    # The pymongo collection without going through model._get_collection(), which builds
+    # every index of the model the first time it's called.
+    return model._get_db()[model._get_collection_name()]
+
+
+def indexName(spec):
+    # The name MongoDB knows the index by: the one in data.py, or the one pymongo makes up
+    # from the fields. Comparing keys doesn't work for text indexes, which MongoDB stores
+    # as _fts/_ftsx instead of the fields.
+    return spec.get('name') or '_'.join(f"{key}_{direction}" for key, direction in spec['fields'])
+
+
+def requireUniqueIndexes():
+    # Models with auto_create_index False (User, see data.py) only get their indexes from
+    # 'flask indexes'. Without their unique indexes duplicate users can be made, so the
+    # servers call this when they start and refuse to run until the indexes are there.
+    missing = []
+    for model in MODELS:
+        if model._meta.get('auto_create_index', True):
+            continue
+        existing = rawCollection(model).index_information()
+        missing += [f"{model._get_collection_name()} {spec['fields']}" for spec in model._meta['index_specs']
+                    if spec.get('unique') and indexName(spec) not in existing]
+    if missing:
+        raise RuntimeError(f"unique indexes missing: {', '.join(missing)}. Run 'flask --app main indexes' first.")
+
+
+@app.cli.command('indexes')
+@click.option('--check', is_flag=True, help="Only report missing indexes, don't create them.")
+def indexes(check):
+    """Create (or check) the indexes declared in data.py and explain the hot queries."""
+    if check:
+        # Don't let the queries below build indexes while this says it only checks them.
+        for model in MODELS:
+            model._meta['auto_create_index'] = False
+    missing = 0
+    duplicates = duplicateEmails()
+    for email, count in duplicates:
+        click.echo(f"{count} users have the email {email}")
+    if duplicates and not check:
+        raise click.ClickException("Merge or delete the users with the same email, then run this again.")
+    for model in MODELS:
+        collection = rawCollection(model)
+        existing = collection.index_information()
+        for spec in model._meta['index_specs']:
+            fields = spec['fields']
+            status = 'ok'
+            if indexName(spec) not in existing:
+                if check:
+                    status = 'MISSING'
+                    missing += 1
+                else:
+                    status = 'created'
+            click.echo(f"{collection.name:10} {status:8} {fields}")
+        if not check:
+            model.ensure_indexes()
+
+    click.echo('')
+    for name, queryset in hotQueries():
+        summary = explainSummary(queryset)
+        flag = '  <-- collection scan' if 'COLLSCAN' in summary['plan'] else ''
+        click.echo(f"{name:15} {summary['plan']} [{summary['index']}] "
+                   f"returned={summary['returned']} keys={summary['keys']} "
+                   f"docs={summary['docs']} {summary['ms']}ms{flag}")
+
+    if missing:
+        raise click.ClickException(f"{missing} index(es) missing. Run 'flask indexes' to create them.")
+
+
+def _childID(entry):
+    # Old replies lists hold generic references: {'_cls': 'Reply', '_ref': DBRef(...)},
+    # or sometimes a plain DBRef or ObjectId.
+    if isinstance(entry, dict):
+        entry = entry.get('_ref')
+    return getattr(entry, 'id', entry)
+
+
+@app.cli.command('migrate-replies')
+def migrateReplies():
+    """Fill in Reply.ancestors for replies that were saved before it existed."""
+    collection = Reply._get_collection()
+    reviewIDs = collection.distinct('review', {'ancestors': {'$exists': False}})
+    for reviewID in reviewIDs:
+        thread = list(collection.find({'review': reviewID}, {'replies': 1}))
+        parentOf = {}
+        for reply in thread:
+            for entry in reply.get('replies') or []:
+                parentOf[_childID(entry)] = reply['_id']
+
+        updates = []
+        for reply in thread:
+            ancestors = []
+            parentID = parentOf.get(reply['_id'])
+            # The check against ancestors stops a broken loop of references from running forever.
+            while parentID is not None and parentID not in ancestors:
+                ancestors.insert(0, parentID)
+                parentID = parentOf.get(parentID)
+            updates.append(UpdateOne({'_id': reply['_id']}, {'$set': {'ancestors': ancestors}}))
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        click.echo(f"review {reviewID}: {len(updates)} replies")
+
+
+@app.cli.command('geocode-backfill')
+@click.option('--batch', default=50, show_default=True, help='Clinics to look up per batch.')
+@click.option('--pause', default=5.0, show_default=True, help='Seconds to wait between batches.')
+def geocodeBackfill(batch, pause):
+    """Look up lat/lon for every clinic that doesn't have one yet."""
+    # Clinics that already have a lat/lon from before 'location' existed just need it copied over.
+    copied = Clinic._get_collection().update_many(
+        {'lat': {'$ne': None}, 'lon': {'$ne': None}, 'location': {'$exists': False}},
+        [{'$set': {'location': {'type': 'Point', 'coordinates': ['$lon', '$lat']}}}]
+    ).modified_count
+    click.echo(f"{copied} clinics had lat/lon copied to location")
+    missing = Q(lat=None) | Q(lon=None)
+    lastID = None
+    done = failed = 0
+    while True:
+        # Page through by _id so clinics that still fail don't get picked up again.
+        query = Clinic.objects(missing)
+        if lastID is not None:
+            query = query.filter(id__gt=lastID)
+        clinicIDs = [clinic.id for clinic in query.only('id').order_by('id').limit(batch)]
+        if not clinicIDs:
+            break
+        for clinicID in clinicIDs:
+            try:
+                geocodeClinic(clinicID)
+                done += 1
+            except GeocodeError as error:
+                failed += 1
+                click.echo(f"clinic {clinicID}: {error}")
+        lastID = clinicIDs[-1]
+        click.echo(f"{done} looked up, {failed} failed")
+        time.sleep(pause)
+
+
+def importTimes(statement):
+    # Run the statement in a fresh python with -X importtime and return
+    # ({module: cumulative microseconds}, total microseconds) from the report it writes to stderr.
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+    times = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:  self [us] | cumulative | imported package" and
+        # nested imports have extra spaces in front of the package name.
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|', 2)
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return times, total
+
+
+@app.cli.command('importtime')
+@click.option('--budget', default=2000, show_default=True, help='Most milliseconds create_app() may take to import.')
+@click.option('--baseline', default='importtime.json', show_default=True, help='Saved results to compare against.')
+@click.option('--save', is_flag=True, help='Save this run as the new baseline.')
+@click.option('--tolerance', default=0.2, show_default=True, help='How much slower a module may get before it counts as a regression.')
+@click.option('--top', default=15, show_default=True, help='How many of the slowest modules to list.')
+def importTime(budget, baseline, save, tolerance, top):
+    """Measure how long it takes to import and create the app."""
+    runs = [importTimes('from app import create_app; create_app()') for _ in range(3)]
+    # The fastest of a few runs is the least affected by whatever else the computer is doing.
+    times = {module: min(run[0].get(module, 0) for run in runs) for module in runs[0][0]}
+    totalMs = min(run[1] for run in runs) / 1000
+
+    click.echo(f"total import time: {totalMs:.0f}ms (budget {budget}ms)")
+    for module, us in sorted(times.items(), key=lambda item: -item[1])[:top]:
+        click.echo(f"{us / 1000:8.1f}ms  {module}")
+
+    problems = []
+    if totalMs > budget:
+        problems.append(f"total import time {totalMs:.0f}ms is over the {budget}ms budget")
+    if os.path.exists(baseline) and not save:
+        with open(baseline) as f:
+            before = json.load(f)
+        for module, us in times.items():
+            old = before.get('modules', {}).get(module)
+            # Ignore tiny modules, their times are mostly noise.
+            if old is not None and us > 5000 and us > old * (1 + tolerance):
+                problems.append(f"{module} got slower: {old / 1000:.1f}ms -> {us / 1000:.1f}ms")
+            if old is None and us > 20000:
+                problems.append(f"new slow import {module}: {us / 1000:.1f}ms")
+    if save:
+        with open(baseline, 'w') as f:
+            json.dump({'totalMs': totalMs, 'modules': times}, f, indent=2, sort_keys=True)
+        click.echo(f"saved {baseline}")
+
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise click.ClickException(f"{len(problems)} import time problem(s)")
+
+
+@app.cli.command('rebuild-hospital-stats')
+def rebuildHospitalStats():
+    """Recalculate HospitalStats from every Review."""
+    # Reviews saved while this runs can be counted twice or missed, so run it when the
+    # site is quiet.
+    HospitalStats.objects().delete()
+    Review._get_collection().aggregate(rebuildPipeline(bySubject=True))
+    Review._get_collection().aggregate(rebuildPipeline(bySubject=False))
+    click.echo(f"{HospitalStats.objects().count()} hospital stats rows rebuilt")
+
+
+@app.cli.command('reconcile-team-counts')
+@click.option('--dry-run', is_flag=True, help="Only report leagues whose team_count is wrong.")
+def reconcileTeamCounts(dry_run):
+    """Set League.team_count to the real number of teams in each league."""
+    wrong = list(League._get_collection().aggregate(teamCountPipeline()))
+    for league in wrong:
+        click.echo(f"league {league['_id']}: team_count={league.get('team_count')} actual={league['actual']}")
+    if wrong and not dry_run:
+        # Only fix a league if its team_count hasn't changed since it was read, so a team
+        # added while this runs isn't lost. Run it again to pick those up.
+        result = League._get_collection().bulk_write([
+            UpdateOne({'_id': league['_id'], 'team_count': league.get('team_count')}, {'$set': {'team_count': league['actual']}})
+            for league in wrong
+        ], ordered=False)
+        click.echo(f"{result.modified_count} of {len(wrong)} league(s) fixed")
+    elif not wrong:
+        click.echo("every team_count is correct")
+
+
+@app.cli.command('bench')
+@click.option('--mongo', default='mongodb://localhost:27017/bench', show_default=True,
+              help="Benchmark database: a MongoDB URI, or 'memory' for an in-memory stand-in.")
+@click.option('--requests', 'requestsPerRoute', default=200, show_default=True, help="Requests per page.")
+@click.option('--concurrency', default=8, show_default=True, help="Requests running at the same time.")
+@click.option('--route', 'routes', multiple=True, help="Only benchmark this endpoint. Can be repeated.")
+@click.option('--save', 'savePath', help="Save the results to this JSON file.")
+@click.option('--compare', 'baselinePath', help="Fail if any page is slower than in this saved JSON file.")
+@click.option('--tolerance', default=0.2, show_default=True, help="How much slower (0.2 = 20%) counts as a regression.")
+def bench(mongo, requestsPerRoute, concurrency, routes, savePath, baselinePath, tolerance):
+    """Load every page at a fixed concurrency and report latency, throughput and queries."""
+    # Imported here, not at the top, so web workers don't load requests, werkzeug's server
+    # and the rest just because create_app() imports this module.
+    from app.utils.bench import runBench, compareResults
+    # Never benchmark against the real database; the benchmark adds its own documents.
+    if mongo == secrets['MONGO_HOST']:
+        raise click.ClickException("--mongo is the site's own database, use a separate one")
+
+    click.echo(f"{'page':25} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'queries':>8} errors")
+
+    def report(endpoint, r):
+        queries = '-' if r['queries'] is None else r['queries']
+        click.echo(f"{endpoint:25} {r['p50']:8} {r['p95']:8} {r['p99']:8} {r['rps']:8} {queries:>8} {r['errors']}")
+
+    results = runBench(mongo, requestsPerRoute, concurrency, only=set(routes), report=report)
+    if savePath:
+        with open(savePath, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo(f"saved {savePath}")
+    if baselinePath:
+        with open(baselinePath) as f:
+            problems = compareResults(json.load(f), results, tolerance)
+        for problem in problems:
+            click.echo(problem)
+        if problems:
+            raise click.ClickException(f"{len(problems)} page(s) got slower than {baselinePath}")
+
+
+@app.cli.command('generate-data')
+@click.option('--mongo', default='mongodb://localhost:27017/bench', show_default=True, help="MongoDB URI to fill.")
+@click.option('--scale', default=1.0, show_default=True, help="1 is about 65,000 documents, 150 about 10 million.")
+@click.option('--seed', default=1, show_default=True, help="The same seed makes the same data.")
+@click.option('--end-date', 'endDate', type=click.DateTime(formats=['%Y-%m-%d']), help="Dates are in the year before this. Defaults to today.")
+@click.option('--batch', default=5000, show_default=True, help="Documents per insert_many.")
+@click.option('--writers', default=4, show_default=True, help="Batches being written at the same time.")
+def generateData(mongo, scale, seed, endDate, batch, writers):
+    """Fill a database with made-up users, blogs, reviews, leagues, listings and clinics."""
+    # Imported here for the same reason as in bench().
+    from app.utils.bench import connectBench
+    from app.utils.fakedata import generate
+    if mongo == secrets['MONGO_HOST']:
+        raise click.ClickException("--mongo is the site's own database, use a separate one")
+    connectBench(mongo)
+    end = endDate or dt.datetime.combine(dt.date.today(), dt.time())
+    generate(scale, seed, end, batchSize=batch, writers=writers, report=click.echo)
+
+
+@app.cli.command('delete-user')
+@click.argument('email')
+def deleteUser(email):
+    """Delete a user and everything they made."""
+    user = User.objects(email=email).first()
+    if user is None:
+        raise click.ClickException(f"no user with email {email}")
+    if markDeleted(user):
+        # The job runs on a background thread, which this command waits for before exiting.
+        # If it's stopped early 'flask resume-deletes' finishes the job.
+        click.echo(f"{email} is hidden, removing everything they made...")
+
+
+@app.cli.command('resume-deletes')
+def resumeDeletes():
+    """Finish delete jobs that were interrupted, and show their progress."""
+    for job in DeleteJob.objects(status='queued'):
+        click.echo(f"{job.model} {job.root}: resuming, removed so far {dict(job.counts)}")
+        # Does nothing if another process still holds the job's lease.
+        runJob(job.id)
+        job.reload()
+        click.echo(f"{job.model} {job.root}: {job.status}, removed {dict(job.counts)}")
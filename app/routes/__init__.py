@@ -1,8 +1,2 @@
-from .default import *
-from .login import *
-from .blog import *
-from .user import *
-from .clinic import *
-from .review import *
-from .league import *
-from .listing import *
\ No newline at end of file
+# Importing each module adds its routes to the app.
+from . import default, login, blog, user, clinic, review, league, listing, media, search, metrics
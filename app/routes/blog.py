@@ -8,6 +8,11 @@ from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
 from app.classes.data import Blog, Comment
 from app.classes.forms import BlogForm, CommentForm
+from app.utils.prefetch import prefetchAuthors
+from app.utils.paginate import paginate
+from app.utils.views import BlogRow, prefetchRowAuthors
+from app.utils.responsecache import cachedPage, bumpVersion
+from app.utils.cascade import markDeleted
 from flask_login import login_required
 import datetime as dt
 
@@ -16,14 +21,20 @@ import datetime as dt
 @app.route('/blogs')
 # This means the user must be logged in to see this page
 @login_required
+# The finished page is kept until a blog or a user changes. See responsecache.py
+@cachedPage('blog', 'user')
 def blogList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    blogs = Blog.objects()
+    # This retrieves one page of the 'blogs' that are stored in MongoDB, newest first.
+    # The next and prev values in the url say which page to get. See paginate.py.
+    # Only the fields blogs.html shows are loaded, not the whole blog. See views.py
+    page = paginate(Blog.objects(), view=BlogRow)
+    # The template shows each blog's author so load all of the authors in one query
+    # instead of one query per blog.
+    blogs = prefetchRowAuthors(page.items)
     # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
     # to the template as a variable named blogs.  The template uses a for loop to display
     # each blog.
-    return render_template('blogs.html',blogs=blogs)
+    return render_template('blogs.html',blogs=blogs,page=page)
 
 # This route will get one specific blog and any comments associated with that blog.  
 # The blogID is a variable that must be passsed as a parameter to the function and 
@@ -41,7 +52,7 @@ def blog(blogID):
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # the blog object (thisBlog in this case) to get all the comments.
-    theseComments = Comment.objects(blog=thisBlog)
+    theseComments = prefetchAuthors(Comment.objects(blog=thisBlog))
     # Send the blog object and the comments object to the 'blog.html' template.
     return render_template('blog.html',blog=thisBlog,comments=theseComments)
 
@@ -58,17 +69,17 @@ def blogDelete(blogID):
     # check to see if the user that is making this request is the author of the blog.
     # current_user is a variable provided by the 'flask_login' library.
     if current_user == deleteBlog.author:
-        # delete the blog using the delete() method from Mongoengine
-        deleteBlog.delete()
+        # The blog disappears right away and its comments are deleted in the background.
+        # See cascade.py
+        markDeleted(deleteBlog)
+        bumpVersion('blog')
         # send a message to the user that the blog was deleted.
         flash('The Blog was deleted.')
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a blog you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    blogs = Blog.objects()  
-    # Send the user to the list of remaining blogs.
-    return render_template('blogs.html',blogs=blogs)
+    # Send the user to the first page of the remaining blogs.
+    return redirect(url_for('blogList'))
 
 # This route actually does two things depending on the state of the if statement 
 # 'if form.validate_on_submit()'. When the route is first called, the form has not 
@@ -105,6 +116,8 @@ def blogNew():
         )
         # This is a method that saves the data to the mongoDB database.
         newBlog.save()
+        # This tells the page cache that the list of blogs has changed.
+        bumpVersion('blog')
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -146,6 +159,7 @@ def blogEdit(blogID):
             tag = form.tag.data,
             modify_date = dt.datetime.utcnow
         )
+        bumpVersion('blog')
         # After updating the document, send the user to the updated blog using a redirect.
         return redirect(url_for('blog',blogID=blogID))
 
@@ -1,12 +1,14 @@
 from app import app
-from app.utils.secrets import getSecrets
-import requests
-from flask import render_template, flash, redirect, url_for
-import requests
+from flask import render_template, flash, redirect, url_for, request, jsonify, abort
 from flask_login import current_user
 from app.classes.data import Clinic
 from app.classes.forms import ClinicForm
 from flask_login import login_required
+from app.utils.paginate import paginate
+from app.utils.views import ClinicRow
+from app.utils.responsecache import cachedPage, bumpVersion
+from app.utils.geocode import queueGeocode, normalizeAddress
+import math
 import datetime as dt
 
 
@@ -14,17 +16,125 @@ import datetime as dt
 @login_required
 def clinicMap():
 
-    clinics = Clinic.objects()
+    # The map loads the clinics itself from /clinic/geojson as the user moves around.
+    return render_template('cliniclocator.html')
 
-    return render_template('cliniclocator.html',clinics=clinics)
+# Below this zoom level clinics that are close together are sent as one cluster.
+app.config.setdefault('CLINIC_CLUSTER_MAX_ZOOM', 14)
+# How many clusters fit across one 256px map tile.
+app.config.setdefault('CLINIC_CLUSTER_CELLS', 8)
+# How long a browser can reuse the clinics for one tile.
+app.config.setdefault('CLINIC_GEOJSON_MAX_AGE', 300)
+
+def parseBbox(bbox):
+    # bbox is "west,south,east,north" in degrees like Leaflet's map.getBounds().toBBoxString()
+    try:
+        west, south, east, north = [float(n) for n in bbox.split(',')]
+    except (AttributeError, ValueError):
+        return None
+    west, east = max(west, -180.0), min(east, 180.0)
+    south, north = max(south, -90.0), min(north, 90.0)
+    if west >= east or south >= north:
+        return None
+    return west, south, east, north
+
+def edgeLatitude(lat, west, east):
+    # The edges of a GeoJSON polygon are great circles, not lines of latitude. Between two
+    # corners at the same latitude the edge bends toward the pole, furthest at the middle.
+    # This is the latitude to put the corners at so the middle of the edge is at lat.
+    halfWidth = math.radians(east - west) / 2
+    return math.degrees(math.atan(math.tan(math.radians(lat)) * math.cos(halfWidth)))
+
+def bboxMatch(west, south, east, north):
+    # The exact box, on the longitude and latitude of the clinic.
+    match = {
+        'location.coordinates.0': {'$gte': west, '$lte': east},
+        'location.coordinates.1': {'$gte': south, '$lte': north},
+    }
+    # A GeoJSON polygon can't be bigger than half the world, so for views that big the
+    # box above is all there is. Otherwise a polygon around the box lets the 2dsphere index
+    # find the clinics. Its south and north edges are moved out where they would bend into
+    # the box, so it never leaves out a clinic the box has.
+    if east - west >= 180 or north - south >= 90:
+        return match
+    if south > 0:
+        south = edgeLatitude(south, west, east)
+    if north < 0:
+        north = edgeLatitude(north, west, east)
+    ring = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+    match['location'] = {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [ring]}}}
+    return match
+
+def clinicFeature(lon, lat, properties):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+        'properties': properties
+    }
+
+def clinicProperties(clinic):
+    return {
+        'id': str(clinic['_id']),
+        'name': clinic.get('name'),
+        'address': f"{clinic.get('streetAddress')}, {clinic.get('city')}, {clinic.get('state')} {clinic.get('zipcode')}",
+        'description': clinic.get('description')
+    }
+
+@app.route('/clinic/geojson')
+@login_required
+def clinicGeojson():
+    bbox = parseBbox(request.args.get('bbox'))
+    zoom = request.args.get('zoom', type=int)
+    if bbox is None or zoom is None:
+        abort(400)
+    match = bboxMatch(*bbox)
+    collection = Clinic._get_collection()
+    fields = {'name': 1, 'streetAddress': 1, 'city': 1, 'state': 1, 'zipcode': 1, 'description': 1, 'location': 1}
+
+    features = []
+    if zoom >= app.config['CLINIC_CLUSTER_MAX_ZOOM']:
+        for clinic in collection.find(match, fields):
+            lon, lat = clinic['location']['coordinates']
+            features.append(clinicFeature(lon, lat, clinicProperties(clinic)))
+    else:
+        # Put the clinics into a grid of cells that get smaller as you zoom in and send
+        # one point per cell. A cell with one clinic in it is sent as that clinic.
+        cell = 360.0 / (2 ** max(zoom, 0)) / app.config['CLINIC_CLUSTER_CELLS']
+        lon = {'$arrayElemAt': ['$location.coordinates', 0]}
+        lat = {'$arrayElemAt': ['$location.coordinates', 1]}
+        pipeline = [
+            {'$match': match},
+            {'$project': fields},
+            {'$group': {
+                '_id': {'x': {'$floor': {'$divide': [lon, cell]}}, 'y': {'$floor': {'$divide': [lat, cell]}}},
+                'count': {'$sum': 1},
+                'lon': {'$avg': lon},
+                'lat': {'$avg': lat},
+                'clinic': {'$first': '$$ROOT'}
+            }}
+        ]
+        for group in collection.aggregate(pipeline):
+            if group['count'] == 1:
+                clinic = group['clinic']
+                features.append(clinicFeature(group['lon'], group['lat'], clinicProperties(clinic)))
+            else:
+                features.append(clinicFeature(group['lon'], group['lat'], {'count': group['count']}))
+
+    response = jsonify({'type': 'FeatureCollection', 'features': features})
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['CLINIC_GEOJSON_MAX_AGE']
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/clinic/list')
 @login_required
+@cachedPage('clinic')
 def clinicList():
 
-    clinics = Clinic.objects()
+    # Clinics use 'createdate' instead of 'create_date' for when they were made.
+    page = paginate(Clinic.objects(), dateField='createdate', view=ClinicRow)
 
-    return render_template('clinics.html',clinics=clinics)
+    return render_template('clinics.html',clinics=page.items,page=page)
 
 
 @app.route('/clinic/<clinicID>')
@@ -42,35 +152,10 @@ def clinicDelete(clinicID):
     deleteClinic = Clinic.objects.get(id=clinicID)
 
     deleteClinic.delete()
+    bumpVersion('clinic')
     flash('The Clinic was deleted.')
     return redirect(url_for('clinicList'))
 
-def updateLatLon(clinic):
-    # get your email address for the secrets file
-    secrets=getSecrets()
-    # call the maps API with the address
-    url = f"https://nominatim.openstreetmap.org/search?street={clinic.streetAddress}&city={clinic.city}&state={clinic.state}&postalcode={clinic.zipcode}&format=json&addressdetails=1&email={secrets['MY_EMAIL_ADDRESS']}"
-    # get the response from the API
-    r = requests.get(url)
-    # Find the lat/lon in the response
-    try:
-        r = r.json()
-    except:
-        flash("unable to retrieve lat/lon")
-        return(clinic)
-    else:
-        if len(r) != 0:
-            # update the database
-            clinic.update(
-                lat = float(r[0]['lat']),
-                lon = float(r[0]['lon'])
-            )
-            flash(f"clinic lat/lon updated")
-            return(clinic)
-        else:
-            flash('unable to retrieve lat/lon')
-            return(clinic)
-
 @app.route('/clinic/new', methods=['GET', 'POST'])
 @login_required
 def clinicNew():
@@ -89,10 +174,11 @@ def clinicNew():
             modifydate = dt.datetime.utcnow,
         )
         newClinic.save()
+        bumpVersion('clinic')
 
-        newClinic = updateLatLon(newClinic)
-
-        import requests
+        # The lat/lon is looked up in the background so the user doesn't have to wait for it.
+        queueGeocode(newClinic)
+        flash("Looking up the clinic's location. It will show on the map shortly.")
 
         return redirect(url_for('clinic',clinicID=newClinic.id))
 
@@ -109,6 +195,8 @@ def clinicEdit(clinicID):
 
     form = ClinicForm()
     if form.validate_on_submit():
+        oldAddress = normalizeAddress(editClinic.streetAddress, editClinic.city, editClinic.state, editClinic.zipcode)
+        newAddress = normalizeAddress(form.streetAddress.data, form.city.data, form.state.data, form.zipcode.data)
         editClinic.update(
             name = form.name.data,
             streetAddress = form.streetAddress.data,
@@ -118,7 +206,11 @@ def clinicEdit(clinicID):
             description = form.description.data,
             modifydate = dt.datetime.utcnow,
         )
-        editClinic = updateLatLon(editClinic)
+        bumpVersion('clinic')
+        # Only look the location up again if the address changed or it was never found.
+        if newAddress != oldAddress or editClinic.lat is None or editClinic.lon is None:
+            queueGeocode(editClinic)
+            flash("Looking up the clinic's location. It will show on the map shortly.")
         return redirect(url_for('clinic',clinicID=clinicID))
 
     form.name.data = editClinic.name
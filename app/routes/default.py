@@ -1,12 +1,23 @@
 from app import app
-from flask import render_template
+from flask import render_template, jsonify
+from flask_login import login_required
+from app.utils.usercache import userCacheInfo
+from app.utils.responsecache import cachedPage, responseCacheInfo
 
 # This is for rendering the home page
 @app.route('/')
+@cachedPage()
 def index():
     return render_template('index.html')
 
 # This is for rendering about us page
 @app.route('/aboutus')
+@cachedPage()
 def aboutus():
-    return render_template('aboutus.html')
\ No newline at end of file
+    return render_template('aboutus.html')
+# This shows how well the logged in user cache and the page cache are working in this
+# server process so their sizes and TTLs can be tuned.
+@app.route('/cachestats')
+@login_required
+def cacheStats():
+    return jsonify(users=userCacheInfo(), pages=responseCacheInfo())
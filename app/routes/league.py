@@ -4,6 +4,11 @@ from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
 from app.classes.data import League, Team
 from app.classes.forms import LeagueForm, TeamForm
+from app.utils.paginate import paginate
+from app.utils.views import LeagueRow
+from app.utils.responsecache import cachedPage, bumpVersion
+from app.utils.cascade import markDeleted
+from app.utils.teamslots import reserveTeamSlot, releaseTeamSlot
 from flask_login import login_required
 import datetime as dt
 
@@ -22,6 +27,7 @@ def leagueNew():
             founder = form.founder.data,
             sport = form.sport.data,
             num_of_teams = form.num_of_teams.data,
+            team_count = 0,
             address = form.address.data,
             author = current_user.id,
             
@@ -30,6 +36,8 @@ def leagueNew():
         )
         # This is a method that saves the data to the mongoDB database.
         newLeague.save()
+        # This tells the page cache that the list of leagues has changed.
+        bumpVersion('league')
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -61,14 +69,18 @@ def league(leagueID):
 @app.route('/leagues')
 # This means the user must be logged in to see this page
 @login_required
+# The finished page is kept until a league changes. See responsecache.py
+@cachedPage('league')
 def leagueList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    leagues = League.objects()
+    # This retrieves one page of the 'leagues' that are stored in MongoDB, newest first.
+    # The next and prev values in the url say which page to get. See paginate.py.
+    # Only the fields leagues.html shows are loaded. See views.py
+    page = paginate(League.objects(), view=LeagueRow)
+    leagues = page.items
     # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
     # to the template as a variable named blogs.  The template uses a for loop to display
     # each blog.
-    return render_template('leagues.html',leagues=leagues)
+    return render_template('leagues.html',leagues=leagues,page=page)
 
 @app.route('/league/edit/<leagueID>', methods=['GET', 'POST'])
 @login_required
@@ -93,6 +105,7 @@ def leagueEdit(leagueID):
             address = form.address.data,
             modify_date = dt.datetime.utcnow
         )
+        bumpVersion('league')
         # After updating the document, send the user to the updated blog using a redirect.
         return redirect(url_for('league',leagueID=leagueID))
 
@@ -118,17 +131,17 @@ def leagueDelete(leagueID):
     # check to see if the user that is making this request is the author of the blog.
     # current_user is a variable provided by the 'flask_login' library.
     if current_user == deleteLeague.author:
-        # delete the blog using the delete() method from Mongoengine
-        deleteLeague.delete()
+        # The league disappears right away and its teams are deleted in the background.
+        # See cascade.py
+        markDeleted(deleteLeague)
+        bumpVersion('league')
         # send a message to the user that the blog was deleted.
         flash('The League was deleted.')
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a league you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    leagues = League.objects()  
-    # Send the user to the list of remaining blogs.
-    return render_template('leagues.html',leagues=leagues)
+    # Send the user to the first page of the remaining leagues.
+    return redirect(url_for('leagueList'))
     
 @app.route('/league/<leagueID>/team/new', methods=['GET', 'POST'])
 @login_required
@@ -136,13 +149,18 @@ def teamNew(leagueID):
     league = League.objects.get(id=leagueID)
     form = TeamForm()
 
-    # Check if the league already has the maximum number of teams
-    current_team_count = Team.objects(league=league).count()
-    if current_team_count >= league.num_of_teams:
+    # Check if the league already has the maximum number of teams. team_count is kept up
+    # to date by teamslots.py; leagues from before it existed are counted when a team is added.
+    if league.team_count is not None and league.team_count >= league.num_of_teams:
         flash(f"Cannot add more than {league.num_of_teams} teams to this league.")
         return redirect(url_for('league', leagueID=leagueID))
 
     if form.validate_on_submit():
+        # The check above can be out of date by the time the form is sent, so take one of
+        # the league's spots before saving. Only one request can get the last spot.
+        if not reserveTeamSlot(league.id):
+            flash(f"Cannot add more than {league.num_of_teams} teams to this league.")
+            return redirect(url_for('league', leagueID=leagueID))
         newTeam = Team(
             name=form.name.data,
             city=form.city.data,
@@ -151,7 +169,12 @@ def teamNew(leagueID):
             author=current_user.id,
             modify_date=dt.datetime.utcnow()
         )
-        newTeam.save()
+        try:
+            newTeam.save()
+        except Exception:
+            # give the spot back if the team didn't get saved
+            releaseTeamSlot(league.id)
+            raise
         return redirect(url_for('league', leagueID=leagueID))
 
     return render_template('teamform.html', form=form)
@@ -165,7 +188,9 @@ def teamDelete(teamID):
     # You could expand this to check if the user is the league's author if needed
     leagueID = str(teamToDelete.league.id)
     
-    teamToDelete.delete()
+    # Only give the league's spot back if this request is the one that deleted the team.
+    if Team.objects(id=teamID).delete():
+        releaseTeamSlot(teamToDelete.league.id)
     flash('Team deleted successfully.')
 
     return redirect(url_for('league', leagueID=leagueID))
\ No newline at end of file
@@ -4,6 +4,10 @@ from flask import render_template, flash, redirect, url_for
 from flask_login import current_user, login_required
 from app.classes.data import Listing
 from app.classes.forms import ListingForm
+from app.utils.paginate import paginate
+from app.utils.views import ListingRow
+from app.utils.responsecache import cachedPage, bumpVersion
+from app.utils.images import saveImage
 import datetime as dt
 
 @app.route('/listing/new', methods=['GET', 'POST'])
@@ -14,7 +18,6 @@ def listingNew():
     if form.validate_on_submit():
         newListing = Listing(
             gym_location=form.gym_location.data,
-            gym_picture=form.gym_picture.data,
             gym_quality=form.gym_quality.data,
             price=form.gym_price.data,
             gym_contact=form.gym_contact.data,
@@ -22,6 +25,9 @@ def listingNew():
             modify_date=dt.datetime.utcnow()
         )
         newListing.save()
+        bumpVersion('listing')
+        if form.gym_picture.data and not saveImage(newListing, 'gym_picture', form.gym_picture.data):
+            flash("That file isn't a JPEG, PNG, GIF or WebP image so it wasn't saved.")
         return redirect(url_for('listing', listingID=newListing.id))
 
     return render_template('listingform.html', form=form)
@@ -35,9 +41,11 @@ def listing(listingID):
 @app.route('/listing/list')
 @app.route('/listings')
 @login_required
+@cachedPage('listing')
 def listingList():
-    listings = Listing.objects()
-    return render_template('listings.html', listings=listings)
+    # Only the fields listings.html shows are loaded, without the pictures. See views.py
+    page = paginate(Listing.objects(), view=ListingRow)
+    return render_template('listings.html', listings=page.items, page=page)
 
 @app.route('/listing/edit/<listingID>', methods=['GET', 'POST'])
 @login_required
@@ -53,16 +61,18 @@ def listingEdit(listingID):
     if form.validate_on_submit():
         editListing.update(
             gym_location=form.gym_location.data,
-            gym_picture=form.gym_picture.data,
             gym_quality=form.gym_quality.data,
             price=form.gym_price.data,
             gym_contact=form.gym_contact.data,
             modify_date=dt.datetime.utcnow()
         )
+        bumpVersion('listing')
+        # Only replace the picture if a new one was uploaded.
+        if form.gym_picture.data and not saveImage(editListing, 'gym_picture', form.gym_picture.data):
+            flash("That file isn't a JPEG, PNG, GIF or WebP image so it wasn't saved.")
         return redirect(url_for('listing', listingID=listingID))
 
     form.gym_location.data = editListing.gym_location
-    form.gym_picture.data = editListing.gym_picture
     form.gym_quality.data = editListing.gym_quality
     form.gym_price.data = editListing.price
     form.gym_contact.data = editListing.gym_contact
@@ -76,9 +86,9 @@ def listingDelete(listingID):
 
     if current_user == deleteListing.author:
         deleteListing.delete()
+        bumpVersion('listing')
         flash('The Listing was deleted.')
     else:
         flash("You can't delete a listing you don't own.")
 
-    listings = Listing.objects()
-    return render_template('listings.html', listings=listings)
\ No newline at end of file
+    return redirect(url_for('listingList'))
\ No newline at end of file
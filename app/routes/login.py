@@ -1,8 +1,11 @@
 
 
 # Python standard libraries
-import json
-from app import app, login_manager
+import os
+import time
+import threading
+import datetime as dt
+from app import app, login_manager, secrets
 from flask import redirect, request, url_for, flash
 from flask_login import (
     current_user,
@@ -11,17 +14,22 @@ from flask_login import (
     logout_user,
 )
 from oauthlib.oauth2 import WebApplicationClient
-import requests
+from werkzeug.http import parse_cache_control_header
+from mongoengine.queryset import QuerySet
 from app.classes.data import User
-from app.utils.secrets import getSecrets
+from app.utils.http import httpSession
+from app.utils.usercache import cachedUser, forgetUser
 import mongoengine.errors
 
-#get all the credentials for google
-secrets = getSecrets()
-
 # OAuth2 client setup
 client = WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
 
+# Where to find Google's list of login urls. GOOGLE_DISCOVERY_URL in the environment can
+# point this at a local test server instead.
+app.config.setdefault('GOOGLE_DISCOVERY_URL', os.environ.get('GOOGLE_DISCOVERY_URL', secrets['GOOGLE_DISCOVERY_URL']))
+# How long to keep Google's list of login urls if Google doesn't say.
+app.config.setdefault('GOOGLE_DISCOVERY_TTL', 60 * 60)
+
 # When a route is decorated with @login_required and fails this code is run
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.unauthorized_handler
 @login_manager.unauthorized_handler
@@ -34,13 +42,27 @@ def unauthorized():
 @login_manager.user_loader
 def load_user(id):
     try:
-        return User.objects.get(pk=id)
+        # Recently loaded users are kept in memory for a few seconds. See usercache.py
+        return cachedUser(id)
     except mongoengine.errors.DoesNotExist:
-        flash("Something strange has happened. This user doesn't exist. Please click logout.")
-        return redirect(url_for('index'))
+        # Deleted, maybe from another session. None makes Flask-Login treat this session
+        # as logged out; anything else would be used as the user.
+        return None
+
+# Google's list of login urls hardly ever changes, so it is kept in memory for as long as
+# Google's Cache-Control header says instead of being downloaded on every login.
+providerCfg = {'cfg': None, 'expires': 0}
+providerCfgLock = threading.Lock()
 
 def get_google_provider_cfg():
-    return requests.get(secrets['GOOGLE_DISCOVERY_URL']).json()
+    with providerCfgLock:
+        if providerCfg['cfg'] is None or time.monotonic() >= providerCfg['expires']:
+            r = httpSession().get(app.config['GOOGLE_DISCOVERY_URL'])
+            r.raise_for_status()
+            maxAge = parse_cache_control_header(r.headers.get('Cache-Control')).max_age
+            providerCfg['cfg'] = r.json()
+            providerCfg['expires'] = time.monotonic() + (maxAge if maxAge is not None else app.config['GOOGLE_DISCOVERY_TTL'])
+        return providerCfg['cfg']
 
 @app.route("/login")
 def login():
@@ -76,7 +98,7 @@ def callback():
         redirect_url=request.base_url,
         code=code,
     )
-    token_response = requests.post(
+    token_response = httpSession().post(
         token_url,
         headers=headers,
         data=body,
@@ -84,14 +106,16 @@ def callback():
     )
 
     # Parse the tokens!
-    client.parse_request_body_response(json.dumps(token_response.json()))
+    client.parse_request_body_response(token_response.text)
 
     # Now that we have tokens (yay) let's find and hit URL
     # from Google that gives you user's profile information,
     # including their Google Profile Image and Email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = httpSession().get(uri, headers=headers, data=body)
+    # Read the answer once instead of every time a value is needed.
+    userinfo = userinfo_response.json()
 
     ### Example info that comes back from google
     # userinfo_response.json() --> {
@@ -114,44 +138,41 @@ def callback():
     # We want to make sure their email is verified.
     # The user authenticated with Google, authorized our
     # app, and now we've verified their email through Google!
-    if userinfo_response.json().get("email_verified"):
-        gid = userinfo_response.json().get("sub","")
-        gmail = userinfo_response.json().get("email","")
-        gprofile_pic = userinfo_response.json().get("picture","")
-        gname = userinfo_response.json().get("name","")
-        gfname = userinfo_response.json().get("given_name","")
-        glname = userinfo_response.json().get("family_name","")
+    if userinfo.get("email_verified"):
+        gid = userinfo.get("sub","")
+        gmail = userinfo.get("email","")
+        gprofile_pic = userinfo.get("picture","")
+        gname = userinfo.get("name","")
+        gfname = userinfo.get("given_name","")
+        glname = userinfo.get("family_name","")
     else:
         return "User email not available or not verified by Google.", 400
 
-    # Get user from DB or create new user
+    # Get user from DB or create new user. This is one atomic find-and-modify: it updates
+    # the user with this email, or creates them if they don't exist yet, and gives back the
+    # saved user. Email has a unique index so two first logins at once can't make two users.
+    googleFields = dict(
+        set__gid = gid,
+        set__gname = gname,
+        set__gprofile_pic = gprofile_pic,
+        set__fname = gfname,
+        set__lname = glname,
+        set_on_insert__createdate = dt.datetime.utcnow()
+    )
+    # User.objects hides deleted users (see data.py), so this looks through all of them.
+    # Otherwise a deleted user whose delete job hasn't finished would get a second
+    # document with the same email, which the unique index refuses.
+    allUsers = QuerySet(User, User._get_collection())
     try:
-        thisUser=User.objects.get(email=gmail)
-    # if the user does not exist, create them and make sure they are ousd.org
-    except mongoengine.errors.DoesNotExist:
-        # if userinfo_response.json().get("hd") == "ousd.org":
-        thisUser = User(
-            gid=gid, 
-            gname=gname, 
-            email=gmail, 
-            gprofile_pic=gprofile_pic,
-            fname = gfname,
-            lname = glname
-        )
-        thisUser.save()
-        thisUser.reload()
-        # else:
-        #     flash("You must have an ousd.org email to login to this site.")
-        #     return redirect(url_for('index'))
-    else:
-        thisUser.update(
-            gid=gid, 
-            gname=gname, 
-            gprofile_pic=gprofile_pic,
-            fname = gfname,
-            lname = glname
-        )
-    thisUser.reload()
+        thisUser = allUsers.filter(email=gmail).modify(upsert=True, new=True, **googleFields)
+    except mongoengine.errors.NotUniqueError:
+        # Another login for the same new user created them first, so now this just updates.
+        thisUser = allUsers.filter(email=gmail).modify(upsert=True, new=True, **googleFields)
+    if thisUser.deleted:
+        flash("This account has been deleted.")
+        return redirect(url_for("index"))
+    # The user's details may have just changed so don't use an older cached copy.
+    forgetUser(thisUser.id)
 
     # Begin user session by logging the user in
     login_user(thisUser)
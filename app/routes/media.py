@@ -0,0 +1,52 @@
+# This route sends images (and any other file) that are stored in MongoDB's GridFS. A
+# FileField like User.image or Listing.gym_picture only stores the id of the file, so a
+# template can show the image like this:
+#     <img src="{{url_for('media', fileID=listing.gym_picture.grid_id)}}">
+# The file is sent a piece at a time so a big image never has to fit in memory, and the
+# browser is told it can keep its copy because a stored file never changes. (Replacing an
+# image stores a new file with a new id.)
+from app import app
+from flask import request, abort
+from flask_login import login_required
+from werkzeug.wsgi import wrap_file
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from mongoengine.connection import get_db
+import gridfs
+from app.utils.images import IMAGE_TYPES
+
+# How long browsers may keep an image before asking for it again (one year).
+MEDIA_MAX_AGE = 60 * 60 * 24 * 365
+
+
+@app.route('/media/<fileID>')
+@login_required
+def media(fileID):
+    try:
+        gridOut = gridfs.GridFS(get_db(), collection='fs').get(ObjectId(fileID))
+    except (InvalidId, gridfs.errors.NoFile):
+        abort(404)
+
+    # wrap_file reads the file one GridFS chunk at a time while the response is sent.
+    data = wrap_file(request.environ, gridOut, buffer_size=gridOut.chunk_size)
+    # Only images are shown in the browser. Anything else (like a file saved before uploads
+    # were checked) is downloaded instead, so it can't run as a page on this site.
+    isImage = gridOut.content_type in IMAGE_TYPES.values()
+    response = app.response_class(
+        data,
+        mimetype=gridOut.content_type if isImage else 'application/octet-stream',
+        direct_passthrough=True
+    )
+    if not isImage:
+        response.headers['Content-Disposition'] = 'attachment'
+    # Don't let the browser guess a different type from what's in the file.
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.content_length = gridOut.length
+    response.set_etag(fileID)
+    response.last_modified = gridOut.upload_date
+    response.cache_control.private = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    # This answers If-None-Match/If-Modified-Since with a 304 and Range requests with
+    # only the bytes that were asked for.
+    return response.make_conditional(request, accept_ranges=True, complete_length=gridOut.length)
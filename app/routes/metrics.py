@@ -0,0 +1,23 @@
+# Prometheus reads the numbers from app/utils/metrics.py here. There's no login since
+# Prometheus can't log in; set METRICS_TOKEN to require 'Authorization: Bearer <token>'.
+import os
+import hmac
+from app import app
+from flask import request, abort
+from prometheus_client import CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(401)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Under gunicorn: add up the numbers every worker has written.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return app.response_class(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
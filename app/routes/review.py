@@ -2,11 +2,16 @@ from app import app
 import mongoengine.errors
 from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
-from app.classes.data import Review, Reply
+from app.classes.data import Review, Reply, HospitalStats
 from app.classes.forms import ReviewForm, ReplyForm
+from app.utils.paginate import paginate
+from app.utils.views import ReviewRow, prefetchRowAuthors
+from app.utils.responsecache import cachedPage, bumpVersion
+from app.utils.cascade import markDeleted
+from app.utils.replies import replyTree, newReply, deleteReply
+from app.utils.hospitalstats import changeStats, reviewValues, ALL_SUBJECTS
 from flask_login import login_required
 import datetime as dt
-from mongoengine.queryset.visitor import Q
 
 @app.route('/review/new', methods=['GET', 'POST'])
 # This means the user must be logged in to see this page
@@ -36,6 +41,10 @@ def reviewNew():
         )
         # This is a method that saves the data to the mongoDB database.
         newReview.save()
+        # Add this rating to the hospital's totals. See hospitalstats.py
+        changeStats(new=reviewValues(newReview))
+        # This tells the page cache that the list of reviews has changed.
+        bumpVersion('review')
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -55,14 +64,19 @@ def reviewNew():
 @app.route('/reviews')
 # This means the user must be logged in to see this page
 @login_required
+# The finished page is kept until a review or a user changes. See responsecache.py
+@cachedPage('review', 'user')
 def reviewList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    reviews = Review.objects()
+    # This retrieves one page of the 'reviews' that are stored in MongoDB, newest first.
+    # The next and prev values in the url say which page to get. See paginate.py.
+    # Only the fields reviews.html shows are loaded, not the review text. See views.py
+    page = paginate(Review.objects(), view=ReviewRow)
+    # Load all of the review authors in one query instead of one query per review.
+    reviews = prefetchRowAuthors(page.items)
     # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
     # to the template as a variable named blogs.  The template uses a for loop to display
     # each blog.
-    return render_template('reviews.html',reviews=reviews)
+    return render_template('reviews.html',reviews=reviews,page=page)
 
 
 
@@ -74,14 +88,12 @@ def reviewList():
 def review(reviewID):
     # retrieve the blog using the blogID
     thisReview = Review.objects.get(id=reviewID)
-    # If there are no comments the 'comments' object will have the value 'None'. Comments are 
-    # related to blogs meaning that every comment contains a reference to a blog. In this case
-    # there is a field on the comment collection called 'blog' that is a reference the Blog
-    # document it is related to.  You can use the blogID to get the blog and then you can use
-    # the blog object (thisBlog in this case) to get all the comments.
-    theseReplies = Reply.objects(Q(review=thisReview) & Q(outer=True) & Q(dFromOuter=0))
-    # Send the blog object and the comments object to the 'blog.html' template.
-    return render_template('review.html',review=thisReview, replies=theseReplies)
+    # Every reply on this review, including replies to replies, is loaded in one query
+    # and put together into a tree. See replies.py for how that works.
+    theseReplies = replyTree(thisReview)
+    # Send the review object and the reply tree to the 'review.html' template.
+    return render_template('review.html',review=thisReview, replies=theseReplies,
+                           collapseDepth=app.config['REPLY_COLLAPSE_DEPTH'])
 
 @app.route('/review/edit/<reviewID>', methods=['GET', 'POST'])
 @login_required
@@ -97,17 +109,22 @@ def reviewEdit(reviewID):
     form = ReviewForm()
     # If the user has submitted the form then update the blog.
     if form.validate_on_submit():
-        # update() is mongoengine method for updating an existing document with new data.
-        editReview.update(
+        # modify() updates the document like update() and also gives back the review as it
+        # was right before this change, so the hospital totals move by exactly this edit
+        # even if someone else edits it at the same moment.
+        oldReview = Review.objects(id=reviewID).modify(
+            new = False,
             name = form.name.data,
             subject = form.subject.data,
             text = form.text.data,
             rating = form.rating.data,
             modify_date = dt.datetime.utcnow
         )
-        theseReplies = Reply.objects(Q(review=editReview) & Q(outer=True) & Q(dFromOuter=0))
+        if oldReview is not None:
+            changeStats(old=reviewValues(oldReview), new={'name': form.name.data, 'subject': form.subject.data, 'rating': form.rating.data})
+        bumpVersion('review')
         # After updating the document, send the user to the updated blog using a redirect.
-        return redirect(url_for('review',reviewID=reviewID, replies=theseReplies))
+        return redirect(url_for('review',reviewID=reviewID))
 
     # if the form has NOT been submitted then take the data from the editBlog object
     # and place it in the form object so it will be displayed to the user on the template.
@@ -130,17 +147,19 @@ def reviewDelete(reviewID):
     # check to see if the user that is making this request is the author of the blog.
     # current_user is a variable provided by the 'flask_login' library.
     if current_user == deleteReview.author:
-        # delete the blog using the delete() method from Mongoengine
-        deleteReview.delete()
+        # The review disappears right away and its replies are deleted in the background
+        # (see cascade.py). markDeleted() is False if someone else deleted it first, so the
+        # rating is only taken out of the totals once.
+        if markDeleted(deleteReview):
+            changeStats(old=reviewValues(deleteReview))
+        bumpVersion('review')
         # send a message to the user that the blog was deleted.
         flash('The Review was deleted.')
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a review you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    reviews = Review.objects()  
-    # Send the user to the list of remaining blogs.
-    return render_template('reviews.html',reviews=reviews)
+    # Send the user to the first page of the remaining reviews.
+    return redirect(url_for('reviewList'))
 
 @app.route('/reply/newRev/<reviewID>', methods=['GET', 'POST'])
 @login_required
@@ -148,17 +167,8 @@ def replyNewRev(reviewID):
     review = Review.objects.get(id=reviewID)
     form = ReplyForm()
     if form.validate_on_submit():
-        newReply = Reply(
-            author = current_user.id,
-            review = reviewID,
-            text = form.text.data,
-            name = review.name,
-            dFromOuter = 0,
-            outer = True
-        )
-        newReply.save()
-        theseReplies = Reply.objects(Q(review=review) & Q(outer=True) & Q(dFromOuter=0))
-        return redirect(url_for('review',reviewID=review.id, replies=theseReplies))
+        newReply(review, current_user.id, form.text.data)
+        return redirect(url_for('review',reviewID=review.id))
     return render_template('replyform.html',form=form,review=review)
 
 @app.route('/reply/newRep/<reviewID>/<replyID>', methods=['GET', 'POST'])
@@ -168,17 +178,7 @@ def replyNewRep(reviewID, replyID):
     reply = Reply.objects.get(id=replyID)
     form = ReplyForm()
     if form.validate_on_submit():
-        newReply = Reply(
-            author = current_user.id,
-            review = reviewID,
-            text = form.text.data,
-            name = review.name,
-            dFromOuter = reply.dFromOuter+1,
-            outer = False
-        )
-        newReply.save()
-        reply.replies.append(newReply)
-        reply.save()
+        newReply(review, current_user.id, form.text.data, parent=reply)
         return redirect(url_for('review',reviewID=review.id))
     return render_template('replyform.html',form=form,review=reply)
 
@@ -197,8 +197,7 @@ def replyEdit(replyID):
             text = form.text.data,
             modify_date = dt.datetime.utcnow
         )
-        theseReplies = Reply.objects(Q(review=review) & Q(outer=True) & Q(dFromOuter=0))
-        return redirect(url_for('review',reviewID=editReply.review.id, replies=theseReplies))
+        return redirect(url_for('review',reviewID=editReply.review.id))
 
     form.text.data = editReply.text
 
@@ -207,13 +206,28 @@ def replyEdit(replyID):
 @app.route('/reply/delete/<replyID>')
 @login_required
 def replyDelete(replyID): 
-    deleteReply = Reply.objects.get(id=replyID)
-    for reply in Reply.objects(Q(review=deleteReply.review) & Q(dFromOuter=(deleteReply.dFromOuter-1))):
-        if reply.replies is not None and deleteReply in reply.replies:
-                replyReplies = reply.replies
-                reply.replies = replyReplies.remove(deleteReply)
-                reply.save()
-    deleteReply.delete()
+    thisReply = Reply.objects.get(id=replyID)
+    reviewID = thisReply.review.id
+    if current_user != thisReply.author:
+        flash("You can't delete a reply you didn't write.")
+        return redirect(url_for('review',reviewID=reviewID))
+    # This also deletes all of the replies to this reply. See replies.py
+    deleteReply(thisReply)
     flash('The reply was deleted.')
-    theseReplies = Reply.objects(Q(review=deleteReply.review) & Q(outer=True) & Q(dFromOuter=0))
-    return redirect(url_for('review',reviewID=deleteReply.review.id, replies=theseReplies)) 
\ No newline at end of file
+    return redirect(url_for('review',reviewID=reviewID)) 
+@app.route('/review/summary')
+@login_required
+def reviewSummary():
+    # Everything on this page comes from the HospitalStats totals, not from the reviews.
+    stats = HospitalStats.objects().order_by('hospital', 'subject')
+    hospitals = {}
+    for row in stats:
+        hospital = hospitals.setdefault(row.hospital, {'all': None, 'subjects': []})
+        if row.subject == ALL_SUBJECTS:
+            hospital['all'] = row
+        elif row.count:
+            hospital['subjects'].append(row)
+    # Best average rating first
+    ranked = sorted((h for h in hospitals.items() if h[1]['all'] and h[1]['all'].count),
+                    key=lambda h: -(h[1]['all'].mean or 0))
+    return render_template('hospitalstats.html', hospitals=ranked, ratings=range(0, 11))
@@ -0,0 +1,46 @@
+# Full text search across blogs, reviews, leagues and listings. Each of those collections
+# has a weighted text index (see data.py) so MongoDB finds the matches and ranks them by
+# how well they match without reading every document.
+from app import app
+from flask import render_template, request
+from flask_login import login_required
+from app.classes.data import Blog, Review, League, Listing
+
+# How many results of each kind to show on a page, and how many pages deep you can go.
+app.config.setdefault('SEARCH_PAGE_SIZE', 10)
+app.config.setdefault('SEARCH_MAX_PAGES', 10)
+
+# kind: (collection, fields the results page shows)
+SEARCHABLE = {
+    'blog': (Blog, ('subject', 'tag', 'create_date')),
+    'review': (Review, ('name', 'subject', 'rating', 'create_date')),
+    'league': (League, ('name', 'sport', 'address')),
+    'listing': (Listing, ('gym_location', 'gym_quality', 'price')),
+}
+
+def searchKind(kind, q, page, size):
+    model, fields = SEARCHABLE[kind]
+    # Best matches first. Only the fields the page shows are loaded. One extra result is
+    # loaded to find out if there is another page.
+    results = list(model.objects.search_text(q).only(*fields).order_by('$text_score')
+                   .skip((page - 1) * size).limit(size + 1))
+    return results[:size], len(results) > size
+
+@app.route('/search')
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('kind')
+    page = max(1, min(request.args.get('page', 1, type=int), app.config['SEARCH_MAX_PAGES']))
+    size = app.config['SEARCH_PAGE_SIZE']
+
+    results = {}
+    if q:
+        # With a kind only that kind is searched so you can page through it, otherwise the
+        # first page of each kind is shown.
+        kinds = [kind] if kind in SEARCHABLE else list(SEARCHABLE)
+        for k in kinds:
+            results[k] = searchKind(k, q, page if kind else 1, size)
+
+    return render_template('search.html', q=q, kind=kind if kind in SEARCHABLE else None,
+                           page=page, maxPages=app.config['SEARCH_MAX_PAGES'], results=results)
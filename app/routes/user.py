@@ -3,8 +3,12 @@ from flask_login.utils import login_required
 from flask_login import current_user
 from flask import render_template, redirect, flash, url_for
 from app.classes.data import User
-from app.classes.forms import ProfileForm
-from flask_login import current_user
+from app.classes.forms import ProfileForm, DeleteAccountForm
+from app.utils.images import saveImage
+from app.utils.usercache import forgetUser
+from app.utils.responsecache import bumpVersion
+from flask_login import current_user, logout_user
+from app.utils.cascade import markDeleted
 
 # These routes and functions are for accessing and editing user profiles.
 
@@ -14,8 +18,10 @@ from flask_login import current_user
 @login_required
 # This is the function that is run when the route is triggered
 def myProfile():
+    # current_user doesn't have the profile image loaded (see usercache.py) so get the whole user.
+    user = User.objects.get(id=current_user.id)
     # This sends the user to their profile page which renders the 'profilemy.html' template
-    return render_template('profilemy.html')
+    return render_template('profilemy.html', user=user, deleteForm=DeleteAccountForm())
 
 # This is the route for editing a profile
 # the methods part is required if you are using a form 
@@ -36,13 +42,13 @@ def profileEdit():
             fname = form.fname.data,
             role = form.role.data
         )
-        # This updates the profile image
-        if form.image.data:
-            if currUser.image:
-                currUser.image.delete()
-            currUser.image.put(form.image.data, content_type = 'image/jpeg')
-            # This saves all the updates
-            currUser.save()
+        # This replaces the profile image and makes the smaller copies of it in the background
+        if form.image.data and not saveImage(currUser, 'image', form.image.data):
+            flash("That file isn't a JPEG, PNG, GIF or WebP image so it wasn't saved.")
+        # Make the next page load the updated user instead of the cached one.
+        forgetUser(currUser.id)
+        # Blog and review lists show the author's name.
+        bumpVersion('user')
         # Then sends the user to their profle page
         return redirect(url_for('myProfile'))
 
@@ -52,5 +58,21 @@ def profileEdit():
     form.lname.data = current_user.lname
     form.role.data = current_user.role
 
-    return render_template('profileform.html', form=form)
+    user = User.objects.get(id=current_user.id)
+    return render_template('profileform.html', form=form, user=user)
+
 
+# This deletes the logged in user's account and everything they made. The account is
+# hidden right away and the rest is removed in the background, see cascade.py
+@app.route('/myprofile/delete', methods=['POST'])
+@login_required
+def profileDelete():
+    if not DeleteAccountForm().validate_on_submit():
+        flash("Your account wasn't deleted. Please try again.")
+        return redirect(url_for('myProfile'))
+    user = User.objects.get(id=current_user.id)
+    markDeleted(user)
+    bumpVersion('user')
+    logout_user()
+    flash('Your account was deleted.')
+    return redirect(url_for('index'))
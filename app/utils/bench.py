@@ -0,0 +1,221 @@
+# Measures how fast every page is, for 'flask bench' (see commands.py).
+#
+# The app is started on a local port against a separate benchmark database, either a local
+# mongod or, with --mongo memory, an in-memory stand-in (needs 'pip install mongomock';
+# text search, geo queries and some aggregations don't work there so those pages show up
+# as errors). Instead of going through Google, every request carries a session cookie for a
+# benchmark user. Every GET page in app/routes is then loaded --requests times by
+# --concurrency threads at once and the results are reported per page:
+#   p50/p95/p99  how long a request took, in milliseconds
+#   rps          requests per second
+#   queries      MongoDB commands per request
+# The load runs in the same process as the server, so compare runs from the same machine.
+import io
+import time
+import threading
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from pymongo import monitoring
+from mongoengine import connect, disconnect
+from werkzeug.serving import make_server
+from PIL import Image
+from app import app, login_manager
+from app.classes.data import User, Blog, Comment, Clinic, Review, Reply, League, Listing
+from app.utils.replies import newReply
+
+BENCH_EMAIL = 'bench@example.com'
+
+# Pages that change data, or need Google, aren't benchmarked. Any url with 'delete' in it
+# is skipped, wherever it is, so the benchmark never deletes its own fixtures.
+SKIP = ('delete', '/login', '/logout', 'static')
+
+# Extra query strings some pages need to do real work.
+QUERY_STRINGS = {
+    'clinicGeojson': {'bbox': '-125,24,-66,50', 'zoom': 4},
+    'search': {'q': 'bench'},
+}
+
+
+class QueryCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name != 'endSessions':
+            with self.lock:
+                self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def connectBench(mongo, counter=None):
+    # Point the app at the benchmark database instead of the one in secrets.py.
+    disconnect()
+    if mongo == 'memory':
+        import mongomock
+        import mongomock.gridfs
+        # Lets gridfs.GridFS take a mongomock database, for the FileFields and images.py.
+        mongomock.gridfs.enable_gridfs_integration()
+        connect('bench', mongo_client_class=mongomock.MongoClient)
+    else:
+        connect(host=mongo, event_listeners=[counter] if counter else [])
+
+
+def tinyJpeg():
+    out = io.BytesIO()
+    Image.new('RGB', (64, 64), (84, 76, 194)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+def benchFixtures():
+    # Returns {url argument name: id} for the pages that show one document. Uses documents
+    # that are already there (like ones from 'flask generate-data') and makes one of each
+    # kind that's missing, written by the benchmark user.
+    user = User.objects(email=BENCH_EMAIL).modify(upsert=True, new=True, set__gname='Bench User',
+                                                  set__fname='Bench', set__lname='User')
+    now = dt.datetime.utcnow()
+
+    blog = Blog.objects(author=user).first() or Blog(
+        author=user, subject='bench blog', content='bench content', tag='bench', modify_date=now).save()
+    comment = Comment.objects(blog=blog).first() or Comment(
+        author=user, blog=blog, content='bench comment', modify_date=now).save()
+    review = Review.objects(author=user).first() or Review(
+        author=user, name='Bench Hospital', subject='bench', text='bench review', rating=7, modify_date=now).save()
+    reply = Reply.objects(review=review).first() or newReply(review, user, 'bench reply')
+    league = League.objects(author=user).first() or League(
+        author=user, name='Bench League', sport='bench', founder='Bench', num_of_teams=8,
+        team_count=0, address='1 Bench St', modify_date=now).save()
+    listing = Listing.objects(author=user, gym_picture__ne=None).first()
+    if listing is None:
+        listing = Listing(author=user, gym_location='Bench Gym', gym_quality='bench', price='1',
+                          gym_contact=BENCH_EMAIL, modify_date=now)
+        listing.gym_picture.put(tinyJpeg(), content_type='image/jpeg')
+        listing.save()
+    clinic = Clinic.objects(location__ne=None).first() or Clinic(
+        author=user, name='Bench Clinic', streetAddress='1 Bench St', city='Oakland', state='CA',
+        zipcode='94612', lat=37.8, lon=-122.27, location=[-122.27, 37.8], modifydate=now).save()
+
+    return user, {
+        'blogID': blog.id,
+        'commentID': comment.id,
+        'reviewID': review.id,
+        'replyID': reply.id,
+        'leagueID': league.id,
+        'listingID': listing.id,
+        'clinicID': clinic.id,
+        'fileID': listing.gym_picture.grid_id,
+    }
+
+
+def benchRoutes(ids):
+    # [(endpoint, url)] for every GET page, filled in with the ids from benchFixtures().
+    routes = {}
+    with app.test_request_context():
+        for rule in app.url_map.iter_rules():
+            if 'GET' not in rule.methods or rule.endpoint in routes or any(s in rule.rule for s in SKIP):
+                continue
+            if any(arg not in ids for arg in rule.arguments):
+                app.logger.warning(f"bench: no id for {rule.rule}, skipped")
+                continue
+            args = {arg: ids[arg] for arg in rule.arguments}
+            args.update(QUERY_STRINGS.get(rule.endpoint, {}))
+            routes[rule.endpoint] = app.url_for(rule.endpoint, **args)
+    return sorted(routes.items())
+
+
+def sessionCookie(user):
+    # The same signed cookie Flask-Login leaves after a real login. '_id' is Flask-Login's
+    # fingerprint of the browser; without a matching one every response would change the
+    # session and none of them could be cached.
+    with app.test_request_context(headers={'User-Agent': requests.utils.default_user_agent()},
+                                  environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        identifier = login_manager._session_identifier_generator()
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'_user_id': str(user.id), '_fresh': True, '_id': identifier})
+
+
+def percentile(sortedTimes, p):
+    return sortedTimes[min(len(sortedTimes) - 1, int(len(sortedTimes) * p / 100))]
+
+
+def runRoute(base, cookie, url, requestsPerRoute, concurrency, counter):
+    local = threading.local()
+
+    def one(_):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.cookies.set(app.config['SESSION_COOKIE_NAME'], cookie)
+        start = time.perf_counter()
+        response = local.session.get(base + url, allow_redirects=False)
+        return time.perf_counter() - start, response.status_code
+
+    # one request first so every route is measured with warm caches
+    one(None)
+    queriesBefore = counter.count
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requestsPerRoute)))
+    elapsed = time.perf_counter() - start
+    queries = counter.count - queriesBefore
+
+    times = sorted(t * 1000 for t, status in results)
+    return {
+        'url': url,
+        'requests': len(results),
+        'errors': sum(1 for t, status in results if status >= 400),
+        'p50': round(percentile(times, 50), 2),
+        'p95': round(percentile(times, 95), 2),
+        'p99': round(percentile(times, 99), 2),
+        'rps': round(len(results) / elapsed, 1),
+        'queries': round(queries / len(results), 2) if counter.count else None,
+    }
+
+
+def runBench(mongo, requestsPerRoute, concurrency, only=None, report=print):
+    counter = QueryCounter()
+    connectBench(mongo, counter)
+    user, ids = benchFixtures()
+    routes = benchRoutes(ids)
+    if only:
+        routes = [(endpoint, url) for endpoint, url in routes if endpoint in only]
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    results = {}
+    try:
+        cookie = sessionCookie(user)
+        for endpoint, url in routes:
+            results[endpoint] = runRoute(base, cookie, url, requestsPerRoute, concurrency, counter)
+            report(endpoint, results[endpoint])
+    finally:
+        server.shutdown()
+    return {'mongo': 'memory' if mongo == 'memory' else 'mongod', 'requests': requestsPerRoute,
+            'concurrency': concurrency, 'routes': results}
+
+
+def compareResults(baseline, current, tolerance, minMs=1.0):
+    # Returns a list of the ways current is slower than baseline. A route regresses when its
+    # p95 grows by more than tolerance (and by at least minMs, so tiny pages don't fail on
+    # noise), its requests per second drop by more than tolerance, or it makes more queries.
+    problems = []
+    for endpoint, base in baseline['routes'].items():
+        now = current['routes'].get(endpoint)
+        if now is None:
+            continue
+        if now['p95'] > base['p95'] * (1 + tolerance) and now['p95'] - base['p95'] >= minMs:
+            problems.append(f"{endpoint}: p95 {base['p95']}ms -> {now['p95']}ms")
+        if now['rps'] < base['rps'] * (1 - tolerance):
+            problems.append(f"{endpoint}: {base['rps']} -> {now['rps']} requests/sec")
+        if base['queries'] is not None and now['queries'] is not None and now['queries'] > base['queries'] + 0.5:
+            problems.append(f"{endpoint}: {base['queries']} -> {now['queries']} queries per request")
+        if now['errors'] > base['errors']:
+            problems.append(f"{endpoint}: {base['errors']} -> {now['errors']} errors")
+    return problems
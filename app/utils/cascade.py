@@ -0,0 +1,179 @@
+# Deletes a user, blog, review or league and everything under it without making the
+# request wait. Deleting one of those the normal way makes mongoengine follow every
+# reverse_delete_rule=CASCADE in data.py one document at a time, which for a busy user
+# (all their blogs, comments, reviews, replies, leagues, teams, listings...) takes seconds.
+# Instead a route calls:
+#     markDeleted(deleteBlog)
+# which sets deleted=True on the blog (so .objects stops finding it, see data.py), saves a
+# DeleteJob and hands the job to a background thread. The job works down the same CASCADE
+# rules in batches: it finds up to CASCADE_BATCH ids of the documents under the ones being
+# deleted, deletes what is under those first, removes their GridFS files and then removes
+# the batch with one delete_many. The marked document itself goes last.
+#
+# Every step of the job can be repeated without removing or counting anything twice, and
+# the job's progress is saved in MongoDB, so if the server stops in the middle the job
+# just runs again: the next markDeleted() anywhere picks up jobs whose lease has run out,
+# and so does
+#     flask --app main resume-deletes
+import os
+import socket
+import datetime as dt
+from mongoengine import CASCADE, FileField
+from mongoengine.queryset.visitor import Q
+from mongoengine.base import get_document
+from app import app
+from app.classes.data import DeleteJob, User, Review, Team
+from app.utils.tasks import submit
+from app.utils.images import gridFS, deleteVariantFiles
+from app.utils.hospitalstats import changeStats
+from app.utils.teamslots import releaseTeamSlot
+from app.utils.responsecache import bumpVersion
+from app.utils.usercache import forgetUser
+
+app.config.setdefault('CASCADE_BATCH', 1000)
+# How long a job belongs to the process running it without that process checking in.
+app.config.setdefault('CASCADE_LEASE', 60 * 5)
+app.config['TASK_POOLS'].setdefault('cascade', 1)
+
+# Nothing in data.py is deeper than this; a reference loop would be.
+MAX_DEPTH = 20
+
+# Fields that removeBatch() needs besides _id and files, to keep other collections right.
+EXTRA_FIELDS = {
+    'Review': ('name', 'subject', 'rating', 'deleted'),
+    'Team': ('league',),
+}
+
+
+def markDeleted(doc):
+    # Returns False if someone else deleted it first.
+    model = type(doc)
+    # The job is saved first so a crash between the two steps can't leave a hidden
+    # document that nothing will ever clean up.
+    job = DeleteJob(model=model.__name__, root=doc.id).save()
+    marked = model._get_collection().update_one(
+        {'_id': doc.id, 'deleted': {'$ne': True}}, {'$set': {'deleted': True}}
+    ).modified_count
+    if not marked:
+        job.delete()
+        return False
+    if model is User:
+        # Don't let a cached copy keep them logged in. Other workers drop theirs within
+        # USER_CACHE_TTL, see usercache.py
+        forgetUser(doc.id)
+    submit(runJob, job.id, pool='cascade')
+    resumeStale()
+    return True
+
+
+def resumeStale():
+    # Jobs nobody is running: queued but never started, or their lease ran out.
+    now = dt.datetime.utcnow()
+    stale = DeleteJob.objects(Q(status='queued') & (Q(lease_until=None) | Q(lease_until__lt=now))).only('id')
+    for job in stale:
+        submit(runJob, job.id, pool='cascade')
+
+
+def _lease():
+    return dt.datetime.utcnow() + dt.timedelta(seconds=app.config['CASCADE_LEASE'])
+
+
+class Progress:
+    def __init__(self, jobID):
+        self.jobID = jobID
+        self.collection = DeleteJob._get_collection()
+        # models something was removed from, so their cached pages can be thrown out
+        self.models = set()
+
+    def add(self, model, count):
+        self.models.add(model.__name__.lower())
+        # Saved after every batch, which also renews the lease.
+        self.collection.update_one({'_id': self.jobID}, {
+            '$inc': {f"counts.{model._get_collection_name()}": count},
+            '$set': {'lease_until': _lease(), 'modify_date': dt.datetime.utcnow()},
+        })
+
+
+def runJob(jobID):
+    now = dt.datetime.utcnow()
+    # Take the job only if nobody else has it, so two workers never run the same one.
+    claimed = DeleteJob._get_collection().find_one_and_update(
+        {'_id': jobID, 'status': 'queued', '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]},
+        {'$set': {'owner': f"{socket.gethostname()}:{os.getpid()}", 'lease_until': _lease()}},
+    )
+    if claimed is None:
+        return
+    model = get_document(claimed['model'])
+    progress = Progress(jobID)
+    cascade(model, [claimed['root']], progress)
+    removeBatch(model, [model._get_collection().find_one({'_id': claimed['root']}, projection(model))], progress)
+    DeleteJob._get_collection().update_one({'_id': jobID}, {'$set': {
+        'status': 'done', 'lease_until': None, 'modify_date': dt.datetime.utcnow()}})
+    if progress.models:
+        bumpVersion(*sorted(progress.models))
+
+
+def fileFields(model):
+    return [name for name, field in model._fields.items() if isinstance(field, FileField)]
+
+
+def projection(model):
+    fields = {'_id': 1}
+    for name in fileFields(model):
+        fields[name] = 1
+        # resized copies, see images.py
+        fields[f"{name}_variants"] = 1
+    for name in EXTRA_FIELDS.get(model.__name__, ()):
+        fields[name] = 1
+    return fields
+
+
+def reviewsRemoved(raws):
+    # Take the ratings out of HospitalStats. A review that was already marked deleted had
+    # its rating taken out then; marking the rest first makes sure it only happens once.
+    collection = Review._get_collection()
+    for raw in raws:
+        if collection.update_one({'_id': raw['_id'], 'deleted': {'$ne': True}}, {'$set': {'deleted': True}}).modified_count:
+            changeStats(old=raw)
+
+
+def removeBatch(model, raws, progress):
+    raws = [raw for raw in raws if raw is not None]
+    if not raws:
+        return
+    # Files first: if this stops before the documents are gone the next run finds them
+    # again, and deleting a file that is already gone does nothing.
+    fs = gridFS()
+    for raw in raws:
+        for name in fileFields(model):
+            if raw.get(name) is not None:
+                fs.delete(raw[name])
+            deleteVariantFiles(fs, (raw.get(f"{name}_variants") or {}).values())
+    if model is Review:
+        reviewsRemoved(raws)
+    result = model._get_collection().delete_many({'_id': {'$in': [raw['_id'] for raw in raws]}})
+    if model is Team:
+        # Give the spots back in the leagues that are staying. If this stops right here
+        # 'flask reconcile-team-counts' fixes the counts.
+        for raw in raws:
+            if raw.get('league') is not None:
+                releaseTeamSlot(raw['league'])
+    progress.add(model, result.deleted_count)
+
+
+def cascade(model, ids, progress, depth=0):
+    # Remove everything that CASCADEs from the documents of 'model' with these ids.
+    if depth > MAX_DEPTH:
+        raise RuntimeError(f"delete cascade deeper than {MAX_DEPTH} levels at {model.__name__}")
+    for (childModel, field), rule in model._meta.get('delete_rules', {}).items():
+        # CASCADE is the only rule data.py uses.
+        if rule != CASCADE:
+            continue
+        collection = childModel._get_collection()
+        while True:
+            batch = list(collection.find({field: {'$in': ids}}, projection(childModel))
+                         .limit(app.config['CASCADE_BATCH']))
+            if not batch:
+                break
+            cascade(childModel, [raw['_id'] for raw in batch], progress, depth + 1)
+            removeBatch(childModel, batch, progress)
@@ -0,0 +1,322 @@
+# Makes a large made-up dataset for 'flask generate-data' (see commands.py), so pages can be
+# tried and benchmarked with production-sized collections. --scale 1 is about 65,000
+# documents; the amount of everything grows with the scale, so --scale 150 is about 10 million.
+#
+# Every document points at documents that really exist: blogs and comments at users,
+# comments at their blog, replies at their review and the replies above them (ancestors),
+# teams at their league (and team_count matches), and images at GridFS files with their
+# resized variants. Every document has its own copy of its files, because replacing or
+# deleting an image deletes its files. HospitalStats is rebuilt from the reviews at the end.
+#
+# The same --seed and --end-date always make the same documents with the same ids, so
+# running it again skips what is already there and fills in anything that's missing.
+#
+# To load fast the documents are built as plain dicts and written with unordered
+# insert_many() batches on a few threads while the next batch is being built, and the
+# indexes are only created at the end.
+import io
+import random
+import struct
+import time
+import threading
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from mongoengine.connection import get_db
+from PIL import Image
+from app.classes.data import User, Blog, Comment, Clinic, Review, HospitalStats, Reply, League, Team, Listing
+from app.utils.images import resize, VARIANTS
+from app.utils.hospitalstats import rebuildPipeline
+from app.utils.responsecache import bumpVersion
+
+# How many of each per --scale 1.
+SIZES = {
+    'users': 1000,
+    'blogs': 5000,
+    'reviews': 3000,
+    'leagues': 300,
+    'listings': 2000,
+    'clinics': 2000,
+    'hospitals': 50,
+}
+COMMENTS_PER_BLOG = 5
+REPLIES_PER_REVIEW = 8
+MAX_REPLY_DEPTH = 12
+USERS_WITH_IMAGES = 0.2
+# Generated images are copies of this many, so making them doesn't take most of the time.
+IMAGE_POOL = 16
+# GridFS's own chunk size. Chunks are written in smaller batches than other documents
+# because each one holds a whole image.
+CHUNK_SIZE = 255 * 1024
+CHUNK_BATCH = 200
+
+WORDS = ('the a gym game team coach season practice field court ball run fast slow great bad '
+         'hospital clinic doctor nurse visit wait room care friendly clean busy quick long '
+         'league match win loss score goal point night morning weekend city park school '
+         'price member open close equipment weights pool class trainer sport soccer '
+         'basketball baseball tennis volleyball hockey track bench knee ankle shoulder').split()
+SUBJECTS = ('Emergency', 'Orthopedics', 'Physical Therapy', 'Sports Medicine', 'Urgent Care', 'Radiology')
+SPORTS = ('soccer', 'basketball', 'baseball', 'tennis', 'volleyball', 'hockey', 'track')
+FIRST_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn')
+LAST_NAMES = ('Garcia', 'Nguyen', 'Smith', 'Johnson', 'Lee', 'Brown', 'Lopez', 'Patel', 'Kim', 'Davis')
+
+
+class Batcher:
+    # Collects documents for each collection and writes them in insert_many() batches on a
+    # small pool of threads. At most 'inflight' batches are waiting at once so memory
+    # stays flat however big the dataset is.
+    def __init__(self, batchSize, writers):
+        self.batchSize = batchSize
+        self.pool = ThreadPoolExecutor(writers)
+        self.inflight = writers * 2
+        self.pending = set()
+        self.buffers = {}
+        self.inserted = {}
+        self.skipped = {}
+        self.countLock = threading.Lock()
+        self.db = get_db()
+
+    def add(self, name, doc, batchSize=None):
+        buffer = self.buffers.setdefault(name, [])
+        buffer.append(doc)
+        if len(buffer) >= (batchSize or self.batchSize):
+            self.send(name)
+
+    def send(self, name):
+        docs = self.buffers.pop(name, [])
+        if not docs:
+            return
+        while len(self.pending) >= self.inflight:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        self.pending.add(self.pool.submit(self.write, name, docs))
+
+    def write(self, name, docs):
+        # Straight to the collection so mongoengine doesn't build indexes in the middle
+        # of the load. Unordered so one duplicate doesn't stop the rest of the batch.
+        try:
+            inserted = len(self.db[name].insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as error:
+            others = [e for e in error.details['writeErrors'] if e['code'] != 11000]
+            if others:
+                raise
+            inserted = error.details['nInserted']
+        with self.countLock:
+            self.inserted[name] = self.inserted.get(name, 0) + inserted
+            self.skipped[name] = self.skipped.get(name, 0) + len(docs) - inserted
+
+    def finish(self):
+        for name in list(self.buffers):
+            self.send(name)
+        for future in self.pending:
+            future.result()
+        self.pool.shutdown()
+
+
+class Generator:
+    def __init__(self, scale, seed, end, batcher):
+        self.scale = scale
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.out = batcher
+        # Every date is in the year before 'end'.
+        self.now = end
+
+    def count(self, name):
+        return max(1, int(SIZES[name] * self.scale))
+
+    def date(self, after=None):
+        # A random time in the last year, later than 'after' if given.
+        start = after or self.now - dt.timedelta(days=365)
+        seconds = max(1, int((self.now - start).total_seconds()))
+        return start + dt.timedelta(seconds=self.rng.randrange(seconds))
+
+    def newID(self, when):
+        # An ObjectId with the same time as the document's create date, made from the seeded
+        # random numbers so the same seed gives the same ids.
+        return ObjectId(struct.pack('>I', int(when.replace(tzinfo=dt.timezone.utc).timestamp()))
+                        + self.rng.getrandbits(64).to_bytes(8, 'big'))
+
+    def text(self, low, high):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(low, high)))
+
+    def fanout(self, mean):
+        # Most documents get a few children and a few get a lot, like real comment threads.
+        return min(int(self.rng.paretovariate(1.5) * mean / 3), mean * 50)
+
+    def images(self):
+        # A small pool of images as (jpeg, {variant: jpeg}), for imageCopy().
+        pool = []
+        for i in range(IMAGE_POOL):
+            img = Image.new('RGB', (1200, 900), tuple(self.rng.randrange(256) for _ in range(3)))
+            out = io.BytesIO()
+            img.save(out, 'JPEG', quality=85)
+            data = out.getvalue()
+            pool.append((data, {name: resize(data, size) for name, size in VARIANTS.items()}))
+        return pool
+
+    def putFile(self, data, filename, when):
+        # The same documents fs.put() would make, written by the batcher instead.
+        fileID = self.newID(when)
+        self.out.add('fs.files', {
+            '_id': fileID, 'length': len(data), 'chunkSize': CHUNK_SIZE, 'uploadDate': when,
+            'filename': filename, 'contentType': 'image/jpeg',
+        })
+        for n, offset in enumerate(range(0, len(data), CHUNK_SIZE)):
+            self.out.add('fs.chunks', {
+                '_id': self.newID(when), 'files_id': fileID, 'n': n, 'data': data[offset:offset + CHUNK_SIZE],
+            }, batchSize=CHUNK_BATCH)
+        return fileID
+
+    def imageCopy(self, images, name, when):
+        # A random image from the pool saved as new files: (original id, {variant: id}).
+        data, variants = self.rng.choice(images)
+        original = self.putFile(data, f"{name}.jpg", when)
+        return original, {variant: str(self.putFile(jpeg, f"{name}-{variant}.jpg", when))
+                          for variant, jpeg in variants.items()}
+
+    def users(self, images):
+        ids = []
+        for i in range(self.count('users')):
+            created = self.date()
+            fname, lname = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+            doc = {
+                '_id': self.newID(created), 'createdate': created,
+                'gname': f"{fname} {lname}", 'fname': fname, 'lname': lname,
+                'email': f"user{i}.seed{self.seed}@example.com",
+            }
+            if self.rng.random() < USERS_WITH_IMAGES:
+                doc['image'], doc['image_variants'] = self.imageCopy(images, f"user-{doc['_id']}", created)
+            self.out.add(User._get_collection_name(), doc)
+            ids.append((doc['_id'], created))
+        return ids
+
+    def author(self, users, after=None):
+        # A random user and a date after they joined (and after 'after').
+        userID, joined = self.rng.choice(users)
+        return userID, self.date(max(joined, after) if after else joined)
+
+    def blogs(self, users):
+        for i in range(self.count('blogs')):
+            authorID, created = self.author(users)
+            blogID = self.newID(created)
+            self.out.add(Blog._get_collection_name(), {
+                '_id': blogID, 'author': authorID, 'subject': self.text(3, 8), 'content': self.text(40, 200),
+                'tag': self.rng.choice(SPORTS), 'create_date': created, 'modify_date': created,
+            })
+            for c in range(self.fanout(COMMENTS_PER_BLOG)):
+                commenterID, when = self.author(users, created)
+                self.out.add(Comment._get_collection_name(), {
+                    '_id': self.newID(when), 'author': commenterID, 'blog': blogID,
+                    'content': self.text(5, 40), 'create_date': when, 'modify_date': when,
+                })
+
+    def reviews(self, users):
+        hospitals = [f"{self.rng.choice(LAST_NAMES)} {self.rng.choice(('General', 'Memorial', 'Community', 'Children'))} Hospital {i}"
+                     for i in range(self.count('hospitals'))]
+        for i in range(self.count('reviews')):
+            authorID, created = self.author(users)
+            reviewID = self.newID(created)
+            name = self.rng.choice(hospitals)
+            self.out.add(Review._get_collection_name(), {
+                '_id': reviewID, 'author': authorID, 'name': name, 'subject': self.rng.choice(SUBJECTS),
+                'text': self.text(20, 120), 'rating': self.rng.randint(0, 10),
+                'create_date': created, 'modify_date': created,
+            })
+            # Each reply answers the review or a reply before it, which makes deep threads.
+            thread = []
+            for r in range(self.fanout(REPLIES_PER_REVIEW)):
+                parent = self.rng.choice(thread) if thread and self.rng.random() < 0.7 else None
+                ancestors = parent['ancestors'] + [parent['_id']] if parent else []
+                if len(ancestors) > MAX_REPLY_DEPTH:
+                    parent, ancestors = None, []
+                replierID, when = self.author(users, parent['create_date'] if parent else created)
+                reply = {
+                    '_id': self.newID(when), 'author': replierID, 'review': reviewID, 'name': name,
+                    'outer': parent is None, 'ancestors': ancestors, 'dFromOuter': len(ancestors),
+                    'text': self.text(5, 40), 'create_date': when, 'modify_date': when,
+                }
+                thread.append(reply)
+                self.out.add(Reply._get_collection_name(), reply)
+
+    def leagues(self, users):
+        for i in range(self.count('leagues')):
+            authorID, created = self.author(users)
+            leagueID = self.newID(created)
+            numTeams = self.rng.randint(4, 16)
+            teams = self.rng.randint(0, numTeams)
+            sport = self.rng.choice(SPORTS)
+            self.out.add(League._get_collection_name(), {
+                '_id': leagueID, 'author': authorID, 'name': f"{self.rng.choice(LAST_NAMES)} {sport} league {i}",
+                'sport': sport, 'founder': self.rng.choice(FIRST_NAMES), 'num_of_teams': numTeams,
+                'team_count': teams, 'address': f"{self.rng.randint(1, 9999)} {self.rng.choice(LAST_NAMES)} St",
+                'create_date': created, 'modify_date': created,
+            })
+            for t in range(teams):
+                coachID, when = self.author(users, created)
+                self.out.add(Team._get_collection_name(), {
+                    '_id': self.newID(when), 'author': coachID, 'league': leagueID,
+                    'name': f"{self.rng.choice(LAST_NAMES)} {self.rng.choice(WORDS).title()}s",
+                    'coach': self.rng.choice(FIRST_NAMES), 'city': self.rng.choice(LAST_NAMES) + 'ville',
+                    'create_date': when, 'modify_date': when,
+                })
+
+    def listings(self, users, images):
+        for i in range(self.count('listings')):
+            authorID, created = self.author(users)
+            listingID = self.newID(created)
+            picture, variants = self.imageCopy(images, f"listing-{listingID}", created)
+            self.out.add(Listing._get_collection_name(), {
+                '_id': listingID, 'author': authorID,
+                'gym_location': f"{self.rng.randint(1, 9999)} {self.rng.choice(LAST_NAMES)} Ave",
+                'gym_picture': picture, 'gym_picture_variants': variants,
+                'gym_quality': self.text(2, 6), 'price': str(self.rng.randint(10, 200)),
+                'gym_contact': f"gym{i}.seed{self.seed}@example.com", 'create_date': created, 'modify_date': created,
+            })
+
+    def clinics(self, users):
+        for i in range(self.count('clinics')):
+            authorID, created = self.author(users)
+            # somewhere in the lower 48 states
+            lat, lon = round(self.rng.uniform(25, 49), 6), round(self.rng.uniform(-124, -67), 6)
+            self.out.add(Clinic._get_collection_name(), {
+                '_id': self.newID(created), 'author': authorID, 'name': f"{self.rng.choice(LAST_NAMES)} Clinic {i}",
+                'streetAddress': f"{self.rng.randint(1, 9999)} {self.rng.choice(LAST_NAMES)} Rd",
+                'city': self.rng.choice(LAST_NAMES) + ' City', 'state': 'CA', 'zipcode': f"{self.rng.randint(10000, 99999)}",
+                'description': self.text(10, 40), 'lat': lat, 'lon': lon,
+                'location': {'type': 'Point', 'coordinates': [lon, lat]},
+                'createdate': created, 'modifydate': created,
+            })
+
+
+def generate(scale, seed, end, batchSize=5000, writers=4, report=print):
+    start = time.perf_counter()
+    batcher = Batcher(batchSize, writers)
+    gen = Generator(scale, seed, end, batcher)
+    images = gen.images()
+    users = gen.users(images)
+    gen.blogs(users)
+    gen.reviews(users)
+    gen.leagues(users)
+    gen.listings(users, images)
+    gen.clinics(users)
+    batcher.finish()
+    report(f"wrote {sum(batcher.inserted.values())} documents in {time.perf_counter() - start:.1f}s")
+    for name in sorted(batcher.inserted):
+        skipped = batcher.skipped.get(name, 0)
+        report(f"  {name:15} {batcher.inserted[name]}" + (f" ({skipped} already there)" if skipped else ''))
+
+    report("creating indexes")
+    for model in (User, Blog, Comment, Clinic, Review, HospitalStats, Reply, League, Team, Listing):
+        model.ensure_indexes()
+    # The indexes fs.put() makes the first time, which reading the files needs.
+    db = get_db()
+    db['fs.files'].create_index([('filename', 1), ('uploadDate', 1)])
+    db['fs.chunks'].create_index([('files_id', 1), ('n', 1)], unique=True)
+    HospitalStats._get_collection().delete_many({})
+    for bySubject in (True, False):
+        Review._get_collection().aggregate(rebuildPipeline(bySubject=bySubject))
+    bumpVersion('user', 'blog', 'review', 'league', 'listing', 'clinic')
+    report(f"done in {time.perf_counter() - start:.1f}s")
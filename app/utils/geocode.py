@@ -0,0 +1,159 @@
+# Looks up the latitude and longitude of a clinic's address with OpenStreetMap's
+# Nominatim service. This used to happen inside the request that saved the clinic, so a
+# slow answer from Nominatim made the user (and the server) wait. Now the routes call
+# queueGeocode(clinic) and the lookup runs on a small pool of background threads that:
+#   - never sends more than GEOCODE_RATE requests a second (Nominatim asks for 1/second)
+#   - gives up on a request after GEOCODE_TIMEOUT seconds
+#   - tries again up to GEOCODE_RETRIES times, waiting longer each time
+# GEOCODER_URL can be pointed at a local test server.
+#
+# Answers are saved in the GeocodeCache collection, keyed by the address after
+# normalizeAddress(), with a small in-memory cache in front of it, so an address that
+# has been looked up before (by any clinic) never goes to the geocoder again.
+import os
+import re
+import time
+import threading
+import datetime as dt
+import requests
+from cachetools import TTLCache
+from app import app, secrets
+from app.classes.data import Clinic, GeocodeCache
+from app.utils.tasks import submit
+from app.utils.http import httpSession
+from app.utils.responsecache import bumpVersion
+
+app.config.setdefault('GEOCODER_URL', os.environ.get('GEOCODER_URL', 'https://nominatim.openstreetmap.org/search'))
+app.config.setdefault('GEOCODE_RATE', 1.0)
+app.config.setdefault('GEOCODE_TIMEOUT', 10)
+app.config.setdefault('GEOCODE_RETRIES', 3)
+app.config.setdefault('GEOCODE_BACKOFF', 2.0)
+app.config.setdefault('GEOCODE_LRU_SIZE', 1024)
+app.config.setdefault('GEOCODE_LRU_TTL', 60 * 60)
+app.config['TASK_POOLS'].setdefault('geocode', 2)
+
+class GeocodeError(Exception):
+    pass
+
+
+class GeocoderBusy(Exception):
+    # The geocoder answered 429 or 5xx. retryAfter is how long it asked us to wait, if it said.
+    def __init__(self, status, retryAfter=None):
+        super().__init__(f"geocoder answered {status}")
+        self.retryAfter = retryAfter
+
+
+class RateLimiter:
+    # Hands out evenly spaced time slots to every thread that calls wait().
+    def __init__(self, perSecond):
+        self.interval = 1.0 / perSecond
+        self.nextSlot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.nextSlot)
+            self.nextSlot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+limiter = RateLimiter(app.config['GEOCODE_RATE'])
+
+
+def lookup(streetAddress, city, state, zipcode):
+    # Returns (lat, lon), or None if the geocoder doesn't know the address.
+    params = {
+        'street': streetAddress,
+        'city': city,
+        'state': state,
+        'postalcode': zipcode,
+        'format': 'json',
+        'addressdetails': 1,
+        'email': secrets['MY_EMAIL_ADDRESS'],
+    }
+    delay = app.config['GEOCODE_BACKOFF']
+    retries = app.config['GEOCODE_RETRIES']
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            r = httpSession().get(app.config['GEOCODER_URL'], params=params, timeout=app.config['GEOCODE_TIMEOUT'])
+            if r.status_code == 429 or r.status_code >= 500:
+                retryAfter = r.headers.get('Retry-After', '')
+                raise GeocoderBusy(r.status_code, float(retryAfter) if retryAfter.isdigit() else None)
+            r.raise_for_status()
+            results = r.json()
+        except (requests.RequestException, ValueError, GeocoderBusy) as error:
+            if attempt == retries:
+                raise GeocodeError(f"geocoding failed after {attempt + 1} tries: {error}") from error
+            time.sleep(getattr(error, 'retryAfter', None) or delay)
+            delay *= 2
+            continue
+        if not results:
+            return None
+        return float(results[0]['lat']), float(results[0]['lon'])
+
+
+# Common words in street addresses and the short form they are saved as, so that
+# "123 North Main Street" and "123 n main st." end up with the same key.
+ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'road': 'rd', 'boulevard': 'blvd', 'drive': 'dr',
+    'lane': 'ln', 'court': 'ct', 'place': 'pl', 'terrace': 'ter', 'highway': 'hwy',
+    'parkway': 'pkwy', 'square': 'sq', 'suite': 'ste', 'apartment': 'apt',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+}
+
+
+def normalizeAddress(streetAddress, city, state, zipcode):
+    def clean(text):
+        words = re.sub(r"[^a-z0-9# ]", " ", (text or '').lower()).split()
+        return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+    zipcode = re.sub(r"[^0-9]", "", zipcode or '')[:5]
+    return '|'.join([clean(streetAddress), clean(city), clean(state), zipcode])
+
+
+# The in-memory cache holds (lat, lon), or None for addresses the geocoder doesn't know.
+memoryCache = TTLCache(maxsize=app.config['GEOCODE_LRU_SIZE'], ttl=app.config['GEOCODE_LRU_TTL'])
+memoryCacheLock = threading.Lock()
+MISSING = object()
+
+
+def cachedLookup(streetAddress, city, state, zipcode):
+    key = normalizeAddress(streetAddress, city, state, zipcode)
+    with memoryCacheLock:
+        found = memoryCache.get(key, MISSING)
+    if found is not MISSING:
+        return found
+
+    saved = GeocodeCache.objects(key=key).first()
+    if saved is not None:
+        found = (saved.lat, saved.lon) if saved.lat is not None else None
+    else:
+        found = lookup(streetAddress, city, state, zipcode)
+        # upsert so two workers looking up the same new address don't collide on the unique key
+        GeocodeCache.objects(key=key).update_one(
+            upsert=True,
+            set__lat=found[0] if found else None,
+            set__lon=found[1] if found else None,
+            set__create_date=dt.datetime.utcnow()
+        )
+    with memoryCacheLock:
+        memoryCache[key] = found
+    return found
+
+
+def geocodeClinic(clinicID):
+    clinic = Clinic.objects(id=clinicID).first()
+    if clinic is None:
+        return
+    found = cachedLookup(clinic.streetAddress, clinic.city, clinic.state, clinic.zipcode)
+    if found is None:
+        app.logger.warning(f"No lat/lon found for clinic {clinicID}")
+        return
+    Clinic.objects(id=clinicID).update_one(set__lat=found[0], set__lon=found[1], set__location=[found[1], found[0]])
+    # The clinic list shows lat/lon
+    bumpVersion('clinic')
+
+
+def queueGeocode(clinic):
+    return submit(geocodeClinic, clinic.id, pool='geocode')
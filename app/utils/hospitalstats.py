@@ -0,0 +1,75 @@
+# Keeps HospitalStats up to date as reviews are added, changed and deleted. Each change is
+# sent to MongoDB as one bulk write of atomic updates, so two reviews saved at the same
+# time can't overwrite each other's totals. The mean is worked out inside the same
+# update so it always matches count and sum.
+from pymongo import UpdateOne
+from app.classes.data import HospitalStats
+
+# The subject used for the row that covers every subject of a hospital.
+ALL_SUBJECTS = '*'
+
+
+def _statsUpdate(hospital, subject, rating, sign):
+    change = [{'$set': {
+        'count': {'$add': [{'$ifNull': ['$count', 0]}, sign]},
+        'sum': {'$add': [{'$ifNull': ['$sum', 0]}, sign * rating]},
+        f"hist.{rating}": {'$add': [{'$ifNull': [f"$hist.{rating}", 0]}, sign]},
+    }}, {'$set': {
+        'mean': {'$cond': [{'$gt': ['$count', 0]}, {'$divide': ['$sum', '$count']}, None]},
+    }}]
+    return UpdateOne({'hospital': hospital, 'subject': subject}, change, upsert=True)
+
+
+def _reviewUpdates(review, sign):
+    # A review without a rating (from before ratings were required) doesn't count.
+    if review.get('rating') is None or not review.get('name'):
+        return []
+    return [
+        _statsUpdate(review['name'], ALL_SUBJECTS, review['rating'], sign),
+        _statsUpdate(review['name'], review.get('subject') or '', review['rating'], sign),
+    ]
+
+
+def reviewValues(review):
+    return {'name': review.name, 'subject': review.subject, 'rating': review.rating}
+
+
+def changeStats(old=None, new=None):
+    # old is the review as it was before the change and new is how it is now, as dicts
+    # from reviewValues(). A new review has no old and a deleted review has no new.
+    updates = []
+    if old is not None:
+        updates += _reviewUpdates(old, -1)
+    if new is not None:
+        updates += _reviewUpdates(new, 1)
+    if updates:
+        HospitalStats._get_collection().bulk_write(updates, ordered=True)
+
+
+def rebuildPipeline(bySubject):
+    group = {'hospital': '$name', 'rating': '$rating'}
+    if bySubject:
+        group['subject'] = {'$ifNull': ['$subject', '']}
+    outer = {'hospital': '$_id.hospital', 'subject': '$_id.subject' if bySubject else ALL_SUBJECTS}
+    return [
+        # reviews marked deleted are on their way out, see cascade.py
+        {'$match': {'rating': {'$ne': None}, 'name': {'$nin': [None, '']}, 'deleted': {'$ne': True}}},
+        {'$group': {'_id': group, 'n': {'$sum': 1}}},
+        {'$group': {
+            '_id': {'hospital': '$_id.hospital', 'subject': '$_id.subject'} if bySubject else {'hospital': '$_id.hospital'},
+            'count': {'$sum': '$n'},
+            'sum': {'$sum': {'$multiply': ['$n', '$_id.rating']}},
+            'hist': {'$push': {'k': {'$toString': '$_id.rating'}, 'v': '$n'}},
+        }},
+        {'$project': {
+            '_id': 0,
+            'hospital': outer['hospital'],
+            'subject': outer['subject'],
+            'count': 1,
+            'sum': 1,
+            'mean': {'$divide': ['$sum', '$count']},
+            'hist': {'$arrayToObject': '$hist'},
+        }},
+        {'$merge': {'into': HospitalStats._get_collection_name(), 'on': ['hospital', 'subject'],
+                    'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+    ]
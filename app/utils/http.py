@@ -0,0 +1,43 @@
+# One shared requests session for every call this app makes to another website (Google
+# login, the geocoder). A session keeps connections open between calls so each call
+# doesn't have to set up a new HTTPS connection, and this one also gives every call a
+# timeout so a slow website can't hang a request forever.
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from app import app
+from app.utils.metrics import recordExternal
+
+app.config.setdefault('HTTP_TIMEOUT', 10)
+app.config.setdefault('HTTP_POOL_SIZE', 10)
+
+
+class TimeoutSession(requests.Session):
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', app.config['HTTP_TIMEOUT'])
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, **kwargs)
+        finally:
+            recordExternal(url, time.perf_counter() - start)
+
+
+_session = None
+_sessionPid = None
+_lock = threading.Lock()
+
+
+def httpSession():
+    global _session, _sessionPid
+    with _lock:
+        # Open connections can't be shared with a forked process, so each worker makes its own.
+        if _session is None or _sessionPid != os.getpid():
+            _session = TimeoutSession()
+            adapter = HTTPAdapter(pool_connections=app.config['HTTP_POOL_SIZE'],
+                                  pool_maxsize=app.config['HTTP_POOL_SIZE'])
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _sessionPid = os.getpid()
+        return _session
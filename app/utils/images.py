@@ -0,0 +1,127 @@
+# Uploaded images are stored at full size, but most pages only show them as a small
+# thumbnail. When an image is uploaded saveImage() stores the original and then, in the
+# background, makes a smaller copy for each size in VARIANTS. The ids of those copies are
+# stored on the document in a field named after the image field, for example
+# User.image -> User.image_variants. Templates ask for the size that fits:
+#     <img src="{{imageUrl(listing, 'gym_picture', 'thumb')}}">
+# and get the original until the smaller copies are ready.
+import io
+import gridfs
+from bson.objectid import ObjectId
+from flask import url_for
+from mongoengine.connection import get_db
+from PIL import Image, ImageOps, UnidentifiedImageError
+from app import app
+from app.utils.tasks import submit
+
+# name: (max width, max height). thumb is twice the 120px the templates show so it
+# still looks sharp on high resolution screens.
+VARIANTS = {
+    'thumb': (240, 240),
+    'card': (600, 600),
+    'full': (1600, 1600),
+}
+VARIANT_QUALITY = 85
+
+# The only kinds of upload that are saved: Pillow's name for the format -> content type.
+IMAGE_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+}
+
+
+def gridFS():
+    # FileField stores its files in the default 'fs' GridFS collection.
+    return gridfs.GridFS(get_db(), collection='fs')
+
+
+def deleteVariantFiles(fs, variantIDs):
+    # The variant ids are saved as strings and GridFS wants the ObjectId; given the string
+    # it deletes nothing and says nothing.
+    for fileID in variantIDs:
+        fs.delete(ObjectId(fileID))
+
+
+def resize(data, size):
+    img = Image.open(io.BytesIO(data))
+    # Phones store the rotation in the EXIF data, apply it before the EXIF is dropped.
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.thumbnail(size, Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=VARIANT_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def buildVariants(model, docID, field, originalID):
+    fs = gridFS()
+    try:
+        original = fs.get(originalID).read()
+    except gridfs.errors.NoFile:
+        # The image was replaced or deleted before this ran.
+        return
+    newIDs = {}
+    try:
+        for name, size in VARIANTS.items():
+            newIDs[name] = str(fs.put(resize(original, size), content_type='image/jpeg',
+                                      filename=f"{docID}-{field}-{name}.jpg"))
+    except (UnidentifiedImageError, OSError) as error:
+        app.logger.warning(f"Could not make variants of {model.__name__}.{field} {docID}: {error}")
+        deleteVariantFiles(fs, newIDs.values())
+        return
+
+    # Only attach the variants if the document still has the same original. If it was
+    # replaced while this was running the newer upload will make its own variants.
+    matched = model._get_collection().update_one(
+        {'_id': docID, field: originalID},
+        {'$set': {f"{field}_variants": newIDs}}
+    ).matched_count
+    if not matched:
+        deleteVariantFiles(fs, newIDs.values())
+
+
+def deleteVariants(doc, field):
+    fs = gridFS()
+    deleteVariantFiles(fs, (doc[f"{field}_variants"] or {}).values())
+    doc[f"{field}_variants"] = {}
+
+
+def imageType(upload):
+    # The content type of the upload if Pillow can read it as one of IMAGE_TYPES, else None.
+    # The type the browser sent can't be trusted; an HTML file sent as an 'image' would
+    # otherwise be served back from this site as a web page.
+    try:
+        img = Image.open(upload.stream)
+        imgFormat = img.format
+        img.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+        return None
+    finally:
+        upload.stream.seek(0)
+    return IMAGE_TYPES.get(imgFormat)
+
+
+def saveImage(doc, field, upload):
+    # Replace the image stored in doc[field] with the uploaded file and queue up the
+    # resized copies. upload is the FileStorage from the form. Returns False, and keeps
+    # the old image, if the upload isn't an image.
+    contentType = imageType(upload)
+    if contentType is None:
+        return False
+    proxy = doc[field]
+    if proxy:
+        proxy.delete()
+    deleteVariants(doc, field)
+    proxy.put(upload, content_type=contentType)
+    doc.save()
+    submit(buildVariants, type(doc), doc.id, field, proxy.grid_id)
+    return True
+
+
+def imageUrl(doc, field, variant='full'):
+    variants = doc[f"{field}_variants"] or {}
+    fileID = variants.get(variant) or doc[field].grid_id
+    return url_for('media', fileID=fileID)
@@ -0,0 +1,99 @@
+# Request metrics for Prometheus, served at /metrics (see app/routes/metrics.py). For each
+# endpoint this records:
+#   http_request_duration_seconds        how long requests took
+#   http_request_db_seconds              ... of which waiting on MongoDB (from querylog.py)
+#   http_request_template_seconds        ... of which rendering templates
+#   http_request_external_seconds        ... of which calling other websites (Google login)
+#   http_response_size_bytes             how big responses were
+#   http_requests_total                  requests by status code
+#   http_request_errors_total            responses with a 5xx status or an exception
+#   http_requests_in_flight              requests being handled right now
+# and external_http_seconds for every call to another website, by host, including the
+# geocoder calls that run in the background.
+#
+# Under gunicorn every worker is its own process with its own numbers. gunicorn.conf.py
+# sets PROMETHEUS_MULTIPROC_DIR so each worker writes its numbers to a file there and
+# /metrics adds up the files of every worker, whichever worker answers.
+import time
+from urllib.parse import urlsplit
+from flask import g, request, has_app_context, before_render_template, template_rendered
+from prometheus_client import Counter, Gauge, Histogram
+from app import app
+
+# Request times in seconds, from 5ms to 10s.
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+REQUEST_TIME = Histogram('http_request_duration_seconds', 'Time to handle a request', ['endpoint', 'method'], buckets=BUCKETS)
+DB_TIME = Histogram('http_request_db_seconds', 'Time a request spent waiting on MongoDB', ['endpoint'], buckets=BUCKETS)
+TEMPLATE_TIME = Histogram('http_request_template_seconds', 'Time a request spent rendering templates', ['endpoint'], buckets=BUCKETS)
+EXTERNAL_TIME = Histogram('http_request_external_seconds', 'Time a request spent calling other websites', ['endpoint'], buckets=BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Size of response bodies', ['endpoint'], buckets=SIZE_BUCKETS)
+REQUESTS = Counter('http_requests_total', 'Requests handled', ['endpoint', 'method', 'status'])
+ERRORS = Counter('http_request_errors_total', 'Requests that ended in a 5xx or an exception', ['endpoint'])
+# livesum: add up the workers that are running now, not ones that have exited.
+IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being handled right now', multiprocess_mode='livesum')
+EXTERNAL_CALLS = Histogram('external_http_seconds', 'Calls to other websites', ['host'], buckets=BUCKETS)
+
+
+def endpointLabel():
+    # The endpoint name, not the path, so /blog/<id> is one label instead of one per blog.
+    return request.endpoint or 'notfound'
+
+
+@app.before_request
+def startMetrics():
+    g.metricsStart = time.perf_counter()
+    g.templateSeconds = 0.0
+    g.externalSeconds = 0.0
+    IN_FLIGHT.inc()
+
+
+@app.after_request
+def responseMetrics(response):
+    endpoint = endpointLabel()
+    REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    # Streamed responses (like /media files) don't know their size up front.
+    if response.content_length is not None:
+        RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+    # Errors are only counted here. An exception the view didn't handle has already been
+    # turned into a 500 response by the time this runs, so counting it in finishMetrics()
+    # too would count it twice.
+    if response.status_code >= 500:
+        ERRORS.labels(endpoint).inc()
+    return response
+
+
+@app.teardown_request
+def finishMetrics(error):
+    # teardown runs even when the view raised, so in-flight always goes back down.
+    start = g.pop('metricsStart', None)
+    if start is None:
+        return
+    IN_FLIGHT.dec()
+    endpoint = endpointLabel()
+    REQUEST_TIME.labels(endpoint, request.method).observe(time.perf_counter() - start)
+    stats = g.get('queryStats')
+    if stats is not None:
+        DB_TIME.labels(endpoint).observe(stats.micros / 1e6)
+    TEMPLATE_TIME.labels(endpoint).observe(g.templateSeconds)
+    EXTERNAL_TIME.labels(endpoint).observe(g.externalSeconds)
+
+
+@before_render_template.connect_via(app)
+def templateStarted(sender, template, context, **extra):
+    g.templateStart = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def templateFinished(sender, template, context, **extra):
+    start = g.pop('templateStart', None)
+    if start is not None and 'templateSeconds' in g:
+        g.templateSeconds += time.perf_counter() - start
+
+
+def recordExternal(url, seconds):
+    # Called by app/utils/http.py for every call to another website.
+    EXTERNAL_CALLS.labels(urlsplit(url).hostname or 'unknown').observe(seconds)
+    if has_app_context() and 'externalSeconds' in g:
+        g.externalSeconds += seconds
@@ -0,0 +1,105 @@
+# Keyset (cursor) pagination for the list pages. Instead of loading every document in a
+# collection, a list page loads one page of documents sorted newest first by
+# (create_date, _id). The link to the next page carries the date and id of the last
+# document on the current page, and the next page starts right after it. Unlike
+# skip/limit this costs the same for page 1 and page 1000 and doesn't shift when new
+# posts are added while someone is paging.
+#
+# In a route:
+#     page = paginate(Blog.objects())
+#     return render_template('blogs.html', blogs=page.items, page=page)
+# and in the template:
+#     {% include 'includes/_pager.html' %}
+# Pass view=SomeRow (see views.py) to only load the fields that row shows, as light rows
+# instead of documents.
+import datetime as dt
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from flask import request
+from mongoengine.queryset.visitor import Q
+from app import app
+
+# How many documents to show on a page. ?size= in the url can change it up to MAX_PAGE_SIZE.
+app.config.setdefault('PAGE_SIZE', 25)
+app.config.setdefault('MAX_PAGE_SIZE', 100)
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+class Page:
+    def __init__(self, items, nextCursor=None, prevCursor=None, size=None):
+        self.items = items
+        self.nextCursor = nextCursor
+        self.prevCursor = prevCursor
+        self.size = size
+
+    @property
+    def hasNext(self):
+        return self.nextCursor is not None
+
+    @property
+    def hasPrev(self):
+        return self.prevCursor is not None
+
+
+def encodeCursor(date, id):
+    # MongoDB stores dates to the millisecond so that is all the cursor needs to hold.
+    ms = (date - EPOCH) // dt.timedelta(milliseconds=1)
+    return f"{ms}-{id}"
+
+
+def decodeCursor(cursor):
+    # A cursor that can't be read is treated like no cursor at all which just shows
+    # the first page.
+    try:
+        ms, id = cursor.split('-', 1)
+        return EPOCH + dt.timedelta(milliseconds=int(ms)), ObjectId(id)
+    except (AttributeError, ValueError, InvalidId):
+        return None
+
+
+def pageSize():
+    size = request.args.get('size', type=int) or app.config['PAGE_SIZE']
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+
+def paginate(queryset, dateField='create_date', size=None, view=None):
+    size = size or pageSize()
+    if view is not None:
+        queryset = view.only(queryset)
+    after = decodeCursor(request.args.get('next'))
+    before = decodeCursor(request.args.get('prev')) if after is None else None
+
+    if before is not None:
+        # Going back a page: take the documents just newer than the cursor in ascending
+        # order and then flip them so the page still reads newest first.
+        date, id = before
+        keyset = Q(**{f"{dateField}__gt": date}) | (Q(**{dateField: date}) & Q(id__gt=id))
+        docs = list(queryset.filter(keyset).order_by(f"+{dateField}", '+id').limit(size + 1))
+        hasPrev = len(docs) > size
+        items = docs[:size][::-1]
+        hasNext = True
+    else:
+        if after is not None:
+            date, id = after
+            keyset = Q(**{f"{dateField}__lt": date}) | (Q(**{dateField: date}) & Q(id__lt=id))
+            queryset = queryset.filter(keyset)
+        # One extra document is loaded to find out if there is another page after this one.
+        docs = list(queryset.order_by(f"-{dateField}", '-id').limit(size + 1))
+        hasNext = len(docs) > size
+        items = docs[:size]
+        hasPrev = after is not None
+
+    nextCursor = prevCursor = None
+    if items:
+        # With a view the items are still plain dicts here.
+        idField = '_id' if view is not None else 'id'
+        if hasNext:
+            last = items[-1]
+            nextCursor = encodeCursor(last[dateField], last[idField])
+        if hasPrev:
+            first = items[0]
+            prevCursor = encodeCursor(first[dateField], first[idField])
+    if view is not None:
+        items = [view(raw) for raw in items]
+    return Page(items, nextCursor, prevCursor, size)
@@ -0,0 +1,53 @@
+# Helpers for loading referenced documents in bulk. When a template loops over a list
+# of documents and touches something like blog.author.fname, mongoengine goes back to
+# MongoDB once for every row to look up that author. prefetch() collects all of the
+# referenced ids up front, loads them with a single $in query and attaches them to the
+# documents so the template never has to go back to the database.
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+
+def _refId(value):
+    # A reference that has not been loaded yet is stored as a DBRef (or a bare ObjectId).
+    # Anything else has already been loaded and doesn't need to be fetched.
+    if isinstance(value, DBRef):
+        return value.id
+    if isinstance(value, ObjectId):
+        return value
+    return None
+
+
+def prefetch(docs, field='author'):
+    # docs can be a queryset or a list. It is turned into a list here so that the same
+    # documents that get the references attached are the ones that get rendered.
+    docs = list(docs)
+    if not docs:
+        return docs
+
+    refField = docs[0]._fields.get(field)
+    if refField is None:
+        return docs
+    refModel = refField.document_type
+
+    ids = set()
+    for doc in docs:
+        refId = _refId(doc._data.get(field))
+        if refId is not None:
+            ids.add(refId)
+    if not ids:
+        return docs
+
+    # One query for all of the referenced documents instead of one per row.
+    refs = {ref.id: ref for ref in refModel.objects(id__in=list(ids))}
+
+    for doc in docs:
+        ref = refs.get(_refId(doc._data.get(field)))
+        if ref is not None:
+            # Writing to _data instead of using setattr keeps the document from being
+            # marked as changed, so a later save() won't rewrite the reference.
+            doc._data[field] = ref
+    return docs
+
+
+def prefetchAuthors(docs):
+    return prefetch(docs, 'author')
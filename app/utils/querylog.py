@@ -0,0 +1,118 @@
+# Counts the MongoDB queries each request makes, including the ones templates make without
+# it being obvious, like {{blog.author.fname}} loading the author. pymongo tells
+# QueryListener about every command it sends, and since a command runs on the thread of
+# the request that made it, the listener adds it to that request's QueryStats in flask.g.
+#
+# Every request keeps a count and the total time, which costs next to nothing. A sample of
+# requests (QUERY_LOG_SAMPLE, 1.0 is all of them) also records the shape of every query
+# (the query with its values taken out) and the slowest one, and for those:
+#   - the response gets a Server-Timing header the browser's developer tools show:
+#         Server-Timing: db;dur=12.4;desc="7 queries", dbslow;dur=5.1;desc="find blog"
+#   - a warning is logged when one shape runs more than QUERY_REPEAT_WARN times, which
+#     usually means a loop (or a template) loading documents one at a time.
+# Commands from background threads aren't part of a request and aren't counted.
+import os
+import random
+from collections import Counter
+from flask import g, has_app_context, request
+from pymongo import monitoring
+from app import app
+
+app.config.setdefault('QUERY_LOG_SAMPLE', float(os.environ.get('QUERY_LOG_SAMPLE', 1.0)))
+app.config.setdefault('QUERY_REPEAT_WARN', 10)
+
+# Commands that are about the connection, not the page.
+IGNORED_COMMANDS = {'endSessions', 'hello', 'isMaster', 'ismaster', 'ping', 'saslStart', 'saslContinue'}
+
+
+class QueryStats:
+    __slots__ = ('count', 'micros', 'sampled', 'shapes', 'pending', 'slowest')
+
+    def __init__(self, sampled):
+        self.count = 0
+        self.micros = 0
+        self.sampled = sampled
+        self.shapes = Counter()
+        # request_id -> shape of commands that have started but not finished
+        self.pending = {}
+        # (micros, shape)
+        self.slowest = (0, None)
+
+    @property
+    def ms(self):
+        return self.micros / 1000
+
+
+def _blank(value):
+    # The query with its values swapped for '?' so the same query with different ids matches.
+    if isinstance(value, dict):
+        return {key: _blank(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_blank(v) for v in value[:1]]
+    return '?'
+
+
+def queryShape(command, name):
+    collection = command.get(name)
+    query = command.get('filter') or command.get('query') or command.get('pipeline')
+    if query is None and name in ('update', 'delete'):
+        ops = command.get('updates') or command.get('deletes') or [{}]
+        query = ops[0].get('q')
+    return f"{name} {collection} {_blank(query) if query else ''}".strip()
+
+
+def currentStats():
+    if not has_app_context():
+        return None
+    return g.get('queryStats')
+
+
+class QueryListener(monitoring.CommandListener):
+    def started(self, event):
+        stats = currentStats()
+        if stats is not None and stats.sampled and event.command_name not in IGNORED_COMMANDS:
+            stats.pending[event.request_id] = queryShape(event.command, event.command_name)
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        stats = currentStats()
+        if stats is None or event.command_name in IGNORED_COMMANDS:
+            return
+        stats.count += 1
+        stats.micros += event.duration_micros
+        if stats.sampled:
+            shape = stats.pending.pop(event.request_id, event.command_name)
+            stats.shapes[shape] += 1
+            if event.duration_micros > stats.slowest[0]:
+                stats.slowest = (event.duration_micros, shape)
+
+
+queryListener = QueryListener()
+
+
+@app.before_request
+def startQueryStats():
+    g.queryStats = QueryStats(random.random() < app.config['QUERY_LOG_SAMPLE'])
+
+
+@app.after_request
+def reportQueryStats(response):
+    stats = g.get('queryStats')
+    if stats is None or not stats.sampled:
+        return response
+    timing = f'db;dur={stats.ms:.1f};desc="{stats.count} queries"'
+    micros, shape = stats.slowest
+    if shape:
+        # Header values can't have quotes in them, and the full shape is in the log anyway.
+        timing += f', dbslow;dur={micros / 1000:.1f};desc="{" ".join(shape.split()[:2])}"'
+    response.headers.add('Server-Timing', timing)
+
+    for shape, count in stats.shapes.items():
+        if count > app.config['QUERY_REPEAT_WARN']:
+            app.logger.warning(f"{request.method} {request.path} ran the same query {count} times: {shape}")
+    return response
@@ -0,0 +1,63 @@
+# Replies on a review form a tree: a reply can be on the review itself or on another
+# reply. Every Reply stores the ids of all of the replies above it in 'ancestors' (the
+# first one is the top-level reply and the last one is its direct parent). That means
+# the whole thread for a review can be loaded with one query and put back together here.
+from app import app
+from app.classes.data import Reply
+from app.utils.prefetch import prefetchAuthors
+
+# Replies nested deeper than this start out collapsed on the review page.
+app.config.setdefault('REPLY_COLLAPSE_DEPTH', 5)
+
+
+class ReplyNode:
+    __slots__ = ('reply', 'children', 'depth')
+
+    def __init__(self, reply, depth=0):
+        self.reply = reply
+        self.children = []
+        self.depth = depth
+
+
+def replyTree(review):
+    # Oldest first, so a parent is always seen before its replies.
+    replies = prefetchAuthors(Reply.objects(review=review).order_by('+create_date', '+id'))
+    nodes = {}
+    roots = []
+    for reply in replies:
+        parent = nodes.get(reply.ancestors[-1]) if reply.ancestors else None
+        if parent is None:
+            node = ReplyNode(reply)
+            roots.append(node)
+        else:
+            node = ReplyNode(reply, parent.depth + 1)
+            parent.children.append(node)
+        nodes[reply.id] = node
+    return roots
+
+
+def newReply(review, author, text, parent=None):
+    ancestors = parent.ancestors + [parent.id] if parent else []
+    reply = Reply(
+        author = author,
+        review = review,
+        text = text,
+        name = review.name,
+        ancestors = ancestors,
+        dFromOuter = len(ancestors),
+        outer = parent is None
+    )
+    reply.save()
+    if parent:
+        # replies is the older way of linking replies, kept up to date for old code.
+        Reply.objects(id=parent.id).update_one(push__replies=reply)
+    return reply
+
+
+def deleteReply(reply):
+    # Deleting a reply also deletes every reply under it. Because each reply stores its
+    # ancestors this is a single delete no matter how big the thread is.
+    Reply._get_collection().delete_many({'$or': [{'_id': reply.id}, {'ancestors': reply.id}]})
+    if reply.ancestors:
+        # Take it out of its parent's older style replies list in the same kind of single step.
+        Reply.objects(id=reply.ancestors[-1]).update_one(pull__replies=reply)
@@ -0,0 +1,122 @@
+# Caches the finished HTML of pages that look the same for everyone, like the home page
+# and the list pages, so a repeat visit doesn't have to query MongoDB or render a template.
+#
+# Each collection has a version number (the CacheVersion collection). Every route that
+# creates, edits or deletes something calls bumpVersion('blog') and so on, and the cache
+# key for a page includes the versions of the collections it shows. After a change the
+# key is different so the old copy is never used again.
+#
+#     @app.route('/blogs')
+#     @login_required
+#     @cachedPage('blog', 'user')
+#     def blogList():
+#
+# The only thing about the user on these pages is the name in the navbar, so pages are
+# cached per navbar name instead of per user. (Names that change on Google's side at login
+# aren't tracked; they show up once RESPONSE_CACHE_TTL runs out.) A page that shows more about the current
+# user should pass its own varyOn function, or not be cached.
+#
+# The cache itself is RESPONSE_CACHE_BACKEND: anything with get(key) and set(key, value).
+# The default keeps pages in this process's memory.
+import time
+import threading
+from functools import wraps
+from cachetools import TTLCache
+from flask import request, session, make_response
+from flask_login import current_user
+from app import app
+from app.classes.data import CacheVersion
+
+app.config.setdefault('RESPONSE_CACHE_SIZE', 512)
+app.config.setdefault('RESPONSE_CACHE_TTL', 60 * 10)
+# How long this process trusts the versions it read from MongoDB. Changes made through this
+# process show up right away; changes made by another gunicorn worker take up to this long.
+app.config.setdefault('RESPONSE_CACHE_VERSION_TTL', 1.0)
+
+
+class MemoryBackend:
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.cache.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+
+
+app.config.setdefault('RESPONSE_CACHE_BACKEND', MemoryBackend(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL']))
+
+versions = {}
+versionsLock = threading.Lock()
+responseCacheStats = {'hits': 0, 'misses': 0}
+# Requests run on several threads at once, and += on a dict entry isn't atomic.
+responseCacheStatsLock = threading.Lock()
+
+
+def getVersions(names):
+    now = time.monotonic()
+    with versionsLock:
+        stale = [name for name in names if name not in versions or versions[name][1] < now]
+    if stale:
+        found = {doc.name: doc.version for doc in CacheVersion.objects(name__in=stale)}
+        with versionsLock:
+            for name in stale:
+                versions[name] = (found.get(name, 0), now + app.config['RESPONSE_CACHE_VERSION_TTL'])
+    with versionsLock:
+        return [versions[name][0] for name in names]
+
+
+def bumpVersion(*names):
+    for name in names:
+        doc = CacheVersion.objects(name=name).modify(upsert=True, new=True, inc__version=1)
+        with versionsLock:
+            versions[name] = (doc.version, time.monotonic() + app.config['RESPONSE_CACHE_VERSION_TTL'])
+
+
+def navbarUser():
+    # base.html only shows the user's name in the navbar.
+    if current_user.is_anonymous:
+        return None
+    return current_user.gname
+
+
+def cachedPage(*collections, varyOn=navbarUser):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # A page with messages waiting to be flashed is different from the cached copy.
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            backend = app.config['RESPONSE_CACHE_BACKEND']
+            queryString = '&'.join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+            versionString = ','.join(str(v) for v in getVersions(collections))
+            key = f"{request.path}?{queryString}|{versionString}|{varyOn()}"
+            hit = backend.get(key)
+            with responseCacheStatsLock:
+                responseCacheStats['hits' if hit is not None else 'misses'] += 1
+            if hit is not None:
+                body, mimetype = hit
+                return app.response_class(body, mimetype=mimetype)
+            response = make_response(view(*args, **kwargs))
+            # Only keep plain successful pages that didn't change the session (like using up
+            # a flashed message) since a cached copy can't do that again.
+            if response.status_code == 200 and not response.direct_passthrough and not session.modified:
+                backend.set(key, (response.get_data(), response.mimetype))
+            return response
+        return wrapper
+    return decorator
+
+
+def responseCacheInfo():
+    with responseCacheStatsLock:
+        hits, misses = responseCacheStats['hits'], responseCacheStats['misses']
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hitRate': hits / lookups if lookups else None,
+    }
@@ -0,0 +1,47 @@
+# Small pools of background threads for work that shouldn't make the user wait, like
+# resizing an uploaded image. A route hands the work off with:
+#     submit(someFunction, arg1, arg2)
+# and returns right away. Work that needs its own limit on how many run at once (like
+# calls to the geocoder) can use a named pool:
+#     submit(someFunction, arg1, pool='geocode')
+# Each pool's size comes from app.config['TASK_POOLS']. The pools are created the first
+# time they are used in each process so they work the same under the dev server and
+# under gunicorn's forked workers.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app import app
+
+app.config.setdefault('TASK_POOLS', {})
+app.config['TASK_POOLS'].setdefault('default', 2)
+
+_executors = {}
+_executorsPid = None
+_lock = threading.Lock()
+
+
+def executor(pool='default'):
+    global _executors, _executorsPid
+    with _lock:
+        # Threads don't survive a fork, so a forked worker needs pools of its own.
+        if _executorsPid != os.getpid():
+            _executors = {}
+            _executorsPid = os.getpid()
+        if pool not in _executors:
+            _executors[pool] = ThreadPoolExecutor(
+                max_workers=app.config['TASK_POOLS'].get(pool, 1),
+                thread_name_prefix=f"task-{pool}"
+            )
+        return _executors[pool]
+
+
+def _logErrors(future):
+    error = future.exception()
+    if error is not None:
+        app.logger.error("Background task failed", exc_info=error)
+
+
+def submit(fn, *args, pool='default', **kwargs):
+    future = executor(pool).submit(fn, *args, **kwargs)
+    future.add_done_callback(_logErrors)
+    return future
@@ -0,0 +1,44 @@
+# Keeps League.team_count equal to the number of teams in the league without counting
+# them. Before a team is saved, reserveTeamSlot() adds one to team_count in a single
+# update that only matches while team_count < num_of_teams, so two people adding a team
+# at the same moment can't both take the last spot. If saving the team then fails, or a
+# team is deleted, releaseTeamSlot() gives the spot back.
+#
+# If team_count ever ends up wrong (say the server died between reserving a spot and
+# saving the team) 'flask reconcile-team-counts' sets it from the real teams again.
+from app.classes.data import League, Team
+
+
+def _countMissing(leagueID):
+    # Leagues made before team_count existed: count their teams once and save it. The
+    # $exists check means a count saved by another request first is left alone.
+    collection = League._get_collection()
+    count = Team.objects(league=leagueID).count()
+    collection.update_one({'_id': leagueID, 'team_count': {'$exists': False}}, {'$set': {'team_count': count}})
+
+
+def reserveTeamSlot(leagueID):
+    # Returns True if a spot was reserved, False if the league is full.
+    collection = League._get_collection()
+    # The $exists check matters: a missing team_count counts as less than any number.
+    query = {'_id': leagueID, 'team_count': {'$exists': True}, '$expr': {'$lt': ['$team_count', '$num_of_teams']}}
+    if collection.update_one(query, {'$inc': {'team_count': 1}}).modified_count:
+        return True
+    if collection.count_documents({'_id': leagueID, 'team_count': {'$exists': False}}):
+        _countMissing(leagueID)
+        return collection.update_one(query, {'$inc': {'team_count': 1}}).modified_count == 1
+    return False
+
+
+def releaseTeamSlot(leagueID):
+    League._get_collection().update_one({'_id': leagueID, 'team_count': {'$gt': 0}}, {'$inc': {'team_count': -1}})
+
+
+def teamCountPipeline():
+    # Every league whose team_count doesn't match how many teams it really has.
+    return [
+        {'$lookup': {'from': Team._get_collection_name(), 'localField': '_id',
+                     'foreignField': 'league', 'as': 'teams'}},
+        {'$project': {'team_count': 1, 'actual': {'$size': '$teams'}}},
+        {'$match': {'$expr': {'$ne': ['$team_count', '$actual']}}},
+    ]
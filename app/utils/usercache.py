@@ -0,0 +1,55 @@
+# Flask-Login loads the logged in user from MongoDB at the start of every request. This
+# keeps recently loaded users in memory for a few seconds so a user clicking around the
+# site doesn't cost a database call per page. Only the fields most pages need are loaded;
+# pages that need the rest (like the profile page) load the full user themselves.
+#
+# The cached user is shared by every request in this process, so treat it as read-only.
+# Anything that changes a user must call forgetUser(id) afterwards. Other gunicorn
+# workers keep their copy until USER_CACHE_TTL runs out.
+import threading
+from cachetools import TTLCache
+from app import app
+from app.classes.data import User
+
+app.config.setdefault('USER_CACHE_SIZE', 1024)
+app.config.setdefault('USER_CACHE_TTL', 30)
+
+# Fields most pages never use.
+USER_CACHE_EXCLUDE = ('image', 'image_variants', 'gprofile_pic')
+
+userCache = TTLCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+userCacheLock = threading.Lock()
+userCacheStats = {'hits': 0, 'misses': 0}
+
+
+def cachedUser(id):
+    # Raises mongoengine.errors.DoesNotExist like User.objects.get() if there is no such user.
+    key = str(id)
+    with userCacheLock:
+        user = userCache.get(key)
+        if user is not None:
+            userCacheStats['hits'] += 1
+            return user
+        userCacheStats['misses'] += 1
+    user = User.objects.exclude(*USER_CACHE_EXCLUDE).get(pk=id)
+    with userCacheLock:
+        userCache[key] = user
+    return user
+
+
+def forgetUser(id):
+    with userCacheLock:
+        userCache.pop(str(id), None)
+
+
+def userCacheInfo():
+    with userCacheLock:
+        lookups = userCacheStats['hits'] + userCacheStats['misses']
+        return {
+            'hits': userCacheStats['hits'],
+            'misses': userCacheStats['misses'],
+            'hitRate': userCacheStats['hits'] / lookups if lookups else None,
+            'size': len(userCache),
+            'maxsize': userCache.maxsize,
+            'ttl': userCache.ttl,
+        }
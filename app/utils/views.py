@@ -0,0 +1,51 @@
+# Light read-only rows for the list pages. A list page only shows a few fields of each
+# document, but loading it the normal way fetches every field (the whole text of a blog,
+# image proxies for a listing) and builds a full mongoengine Document for each row. Here
+# MongoDB only sends the fields the page shows (a projection), they come back as plain
+# dicts (as_pymongo) and each one is put in a small class with __slots__, which the
+# templates use just like a document: {{blog.subject}}, {{blog.author.fname}}.
+#
+# In a route:
+#     page = paginate(Blog.objects(), view=BlogRow)
+#     blogs = prefetchRowAuthors(page.items)
+# A template that shows another field needs it added to the row class below, otherwise it
+# just shows up blank.
+from app.classes.data import User
+
+
+class Row:
+    __slots__ = ('id',)
+    # The fields loaded from MongoDB, not counting _id.
+    FIELDS = ()
+
+    def __init__(self, raw):
+        self.id = raw['_id']
+        for field in self.FIELDS:
+            setattr(self, field, raw.get(field))
+
+    @classmethod
+    def only(cls, queryset):
+        return queryset.only(*cls.FIELDS).as_pymongo()
+
+
+def rowView(name, *fields):
+    return type(name, (Row,), {'__slots__': fields, 'FIELDS': fields})
+
+
+AuthorRow = rowView('AuthorRow', 'fname', 'lname')
+BlogRow = rowView('BlogRow', 'author', 'subject', 'create_date')
+ReviewRow = rowView('ReviewRow', 'author', 'name', 'subject', 'rating', 'create_date')
+ListingRow = rowView('ListingRow', 'gym_location', 'gym_quality', 'price', 'gym_contact', 'create_date')
+LeagueRow = rowView('LeagueRow', 'name', 'founder', 'address', 'create_date')
+ClinicRow = rowView('ClinicRow', 'name', 'streetAddress', 'city', 'description', 'lat', 'lon', 'createdate')
+
+
+def prefetchRowAuthors(rows):
+    # Like prefetchAuthors() in prefetch.py: every author on the page in one query, also as rows.
+    ids = {row.author for row in rows if row.author is not None}
+    if not ids:
+        return rows
+    authors = {raw['_id']: AuthorRow(raw) for raw in AuthorRow.only(User.objects(id__in=list(ids)))}
+    for row in rows:
+        row.author = authors.get(row.author)
+    return rows
@@ -0,0 +1,95 @@
+# Settings for running the site with gunicorn, which is how it should run anywhere other
+# than your own computer. gunicorn reads this file by itself when started from this folder:
+#
+#     gunicorn main:app
+#
+# main.py's app.run() is only for development: one process, the debugger and the reloader.
+# See "Running in production" in setup.txt for when to use which.
+#
+# Every setting can be changed with an environment variable without editing this file.
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+# main.py sets this for the development server; Google's login needs it either way.
+os.environ.setdefault('OAUTHLIB_RELAX_TOKEN_SCOPE', '1')
+
+# Where each worker writes its /metrics numbers so they can be added up. This has to be
+# set before the app is loaded. See app/utils/metrics.py
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'blankcapstone-metrics'))
+# Start empty; numbers left over from the last time gunicorn ran would be added in again.
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# Most of the time spent on a request here is waiting on MongoDB or Google, not running
+# Python. 'gthread' workers keep a few threads each so one worker can wait on several
+# requests at once, with one worker per CPU. 'sync' workers handle one request at a time so
+# they need more of them: the usual 2 x CPUs + 1.
+cpus = multiprocessing.cpu_count()
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'gthread':
+    workers = int(os.environ.get('WEB_CONCURRENCY', max(2, cpus)))
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY', cpus * 2 + 1))
+
+# Load the app once in the main process and then fork the workers from it. Startup only
+# happens once and the workers share the memory it used. The MongoDB connection is not
+# shared; post_fork() below gives each worker its own.
+preload_app = True
+
+# A request that takes longer than this gets its worker restarted.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# How long workers get to finish the requests they have when stopping or restarting.
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+# How long to keep a browser's (or a load balancer's) connection open for its next request.
+# Behind a load balancer this should be longer than the load balancer's own idle timeout.
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Restart each worker after about this many requests so slow memory growth can't build up.
+# The jitter makes workers restart at different times instead of all at once.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# The heartbeat file workers touch; memory is much faster than disk in containers.
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Trust X-Forwarded-Proto from the load balancer so url_for() and the Google login
+# redirect use https.
+forwarded_allow_ips = os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1')
+
+# gunicorn can serve https itself with the same certificate the development server uses.
+if os.environ.get('GUNICORN_CERTFILE'):
+    certfile = os.environ['GUNICORN_CERTFILE']
+    keyfile = os.environ.get('GUNICORN_KEYFILE')
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-')
+
+
+def when_ready(server):
+    # Runs once before any worker starts. gunicorn stops with the message if this raises.
+    from app import connectDB
+    from app.commands import requireUniqueIndexes
+    requireUniqueIndexes()
+    # Don't leave the workers a client made before the fork.
+    connectDB()
+
+
+def post_fork(server, worker):
+    # A MongoDB client can't be used on both sides of a fork, so each worker sets up its own.
+    from app import connectDB
+    connectDB()
+    # Nominatim allows GEOCODE_RATE requests a second for the whole site, and each worker
+    # has its own geocode pool, so each worker gets its share of that.
+    from app.utils import geocode
+    geocode.limiter.interval *= server.cfg.workers
+
+
+def child_exit(server, worker):
+    # Stop counting an exited worker's in-flight requests.
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,10 +1,17 @@
-
-from app import app
+from app import create_app
 import os
 
+app = create_app()
+
+# Running this file starts the development server. In production run 'gunicorn main:app'
+# instead, which uses the settings in gunicorn.conf.py.
 if __name__ == "__main__":
     
     os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
+
+    # Like gunicorn.conf.py, don't start without the unique user indexes.
+    from app.commands import requireUniqueIndexes
+    requireUniqueIndexes()
     
     # app.run(debug="True", ssl_context='adhoc')
-    app.run(debug="True",use_reloader=True, ssl_context=('cert.pem', 'key.pem'))
\ No newline at end of file
+    app.run(debug="True",use_reloader=True, ssl_context=('cert.pem', 'key.pem'))